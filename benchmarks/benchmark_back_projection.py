@@ -0,0 +1,154 @@
+"""
+Benchmark of the vectorized mask back-projection, full-frame and per-instance bounding box, against the original
+per-pixel loop.
+
+Run from the root of the repository:
+    python3 -m benchmarks.benchmark_back_projection
+"""
+import math
+import timeit
+
+import numpy as np
+
+from rob7_760_2024.LIB import RayLookupTable, back_project_instances
+
+
+# Intrinsics of the TIAGo head camera (640x480)
+CAMERA_MATRIX = np.array([[522.19, 0.0, 320.5],
+                          [0.0, 522.19, 240.5],
+                          [0.0, 0.0, 1.0]])
+
+
+def loop_back_projection(masks, label_ids, depth_image, camera_matrix):
+    """
+    Function reproducing the original nested-loop implementation of 'find_3d_positions'.
+    """
+    labeled_points_3d = []
+    fx, fy = camera_matrix[0, 0], camera_matrix[1, 1]
+    cx, cy = camera_matrix[0, 2], camera_matrix[1, 2]
+
+    for mask, label_id in zip(masks, label_ids):
+        height, width = mask.shape
+        for v in range(height):
+            for u in range(width):
+                if mask[v, u]:
+                    depth_value = depth_image[v, u]
+                    if depth_value == 0:
+                        continue
+                    z = depth_value
+                    x = (u - cx) * z / fx
+                    y = (v - cy) * z / fy
+                    labeled_points_3d.append((x, y, z, label_id))
+
+    valid_points = []
+    for point in labeled_points_3d:
+        x, y, z, label = point
+        if math.isnan(x) or math.isinf(x) or math.isnan(y) or math.isinf(y) or math.isnan(z) or math.isinf(z):
+            continue
+        valid_points.append(point)
+
+    return valid_points
+
+
+def back_project_masks(masks, label_ids, depth_image, ray_table):
+    """
+    Function for back-projecting a stack of full-frame object masks into 3D camera-frame points in one vectorized pass,
+    the full-frame reference 'back_project_instances' is compared against.
+
+    Args:
+        masks (np.ndarray): Stack of masks with shape (M, H, W). Non-zero pixels belong to the object.
+        label_ids (sequence): Label id of each of the M masks.
+        depth_image (np.ndarray): Depth image with shape (H, W), in metres.
+        ray_table (RayLookupTable): Cached unit rays of the camera the depth image belongs to.
+
+    Returns:
+        np.ndarray: Array with shape (N, 4) holding x, y, z and label id of every valid point.
+    """
+    masks = np.asarray(masks)
+    if masks.ndim == 2:
+        masks = masks[np.newaxis]
+    if masks.shape[0] == 0:
+        return np.empty((0, 4), dtype=np.float32)
+
+    label_ids = np.asarray(label_ids, dtype=np.float32)
+    depth_image = np.asarray(depth_image, dtype=np.float32)
+
+    # Indices of every masked pixel, together with the mask it belongs to
+    mask_index, v, u = np.nonzero(masks)
+    z = depth_image[v, u]
+
+    # Skip invalid (zero) and non-finite depth values before doing any arithmetic
+    valid = (z != 0) & np.isfinite(z)
+    mask_index, v, u, z = mask_index[valid], v[valid], u[valid], z[valid]
+
+    points = np.empty((z.shape[0], 4), dtype=np.float32)
+    points[:, 0] = ray_table.ray_x[v, u] * z
+    points[:, 1] = ray_table.ray_y[v, u] * z
+    points[:, 2] = z
+    points[:, 3] = label_ids[mask_index]
+
+    # Drop any point where x or y became NaN or Inf
+    return points[np.isfinite(points[:, :3]).all(axis=1)]
+
+
+def make_frame(height=480, width=640, seed=0):
+    """
+    Function for generating a synthetic depth image and two large object masks.
+    """
+    rng = np.random.default_rng(seed)
+    depth_image = rng.uniform(0.5, 6.0, size=(height, width)).astype(np.float32)
+
+    # Sprinkle in invalid depth readings like a real sensor
+    depth_image[rng.random((height, width)) < 0.05] = 0.0
+    depth_image[rng.random((height, width)) < 0.01] = np.nan
+
+    masks = np.zeros((2, height, width), dtype=np.uint8)
+    masks[0, 100:400, 50:300] = 1    # e.g. a couch
+    masks[1, 150:450, 350:600] = 1   # e.g. a chair
+
+    return masks, [2, 3], depth_image
+
+
+def to_instances(masks):
+    """
+    Function for converting full-frame masks into instances cropped to their bounding box.
+    """
+    instances = []
+    for mask in masks:
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        bbox = (cols[0], rows[0], cols[-1] + 1, rows[-1] + 1)
+        instances.append({'bbox': bbox, 'mask': mask[bbox[1]:bbox[3], bbox[0]:bbox[2]] > 0})
+    return instances
+
+
+def main():
+    masks, label_ids, depth_image = make_frame()
+    ray_table = RayLookupTable(CAMERA_MATRIX, depth_image.shape[1], depth_image.shape[0])
+
+    loop_points = loop_back_projection(masks, label_ids, depth_image, CAMERA_MATRIX)
+    vectorized_points = back_project_masks(masks, label_ids, depth_image, ray_table)
+    instances = to_instances(masks)
+    instance_points = back_project_instances(instances, label_ids, depth_image, ray_table)
+
+    # Both implementations must agree on the resulting points
+    assert len(loop_points) == len(vectorized_points)
+    assert np.allclose(np.array(loop_points, dtype=np.float32), vectorized_points, atol=1e-4)
+    assert np.allclose(instance_points, vectorized_points, atol=1e-4)
+
+    loop_time = min(timeit.repeat(
+        lambda: loop_back_projection(masks, label_ids, depth_image, CAMERA_MATRIX), number=1, repeat=3))
+    vectorized_time = min(timeit.repeat(
+        lambda: back_project_masks(masks, label_ids, depth_image, ray_table), number=10, repeat=5)) / 10
+    instance_time = min(timeit.repeat(
+        lambda: back_project_instances(instances, label_ids, depth_image, ray_table), number=10, repeat=5)) / 10
+
+    print(f"Points per frame: {len(vectorized_points)}")
+    print(f"Loop:       {loop_time * 1000:9.2f} ms/frame")
+    print(f"Vectorized: {vectorized_time * 1000:9.2f} ms/frame")
+    print(f"Instances:  {instance_time * 1000:9.2f} ms/frame")
+    print(f"Speedup:    {loop_time / vectorized_time:9.1f}x (full frame), {loop_time / instance_time:.1f}x (instances)")
+
+
+if __name__ == "__main__":
+    main()
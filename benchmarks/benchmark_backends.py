@@ -0,0 +1,45 @@
+"""
+Per-frame latency of the segmentation model for each inference backend, on the same recorded frames.
+
+Run from the root of the repository, optionally with a folder of recorded frames:
+    python3 -m benchmarks.benchmark_backends --frames /path/to/frames --backends torch onnx openvino
+"""
+import argparse
+import time
+
+import numpy as np
+
+from rob7_760_2024.LIB import INFERENCE_BACKENDS, YoloSegmenter, export_model
+from benchmarks.benchmark_batch_inference import LABEL_MAPPING, load_frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='yolo11x-seg.pt', help="PyTorch segmentation model to export")
+    parser.add_argument('--frames', default=None, help="Folder with recorded .png/.jpg frames")
+    parser.add_argument('--num-frames', type=int, default=50, help="Number of frames to run per backend")
+    parser.add_argument('--backends', nargs='+', default=list(INFERENCE_BACKENDS), choices=INFERENCE_BACKENDS)
+    parser.add_argument('--cache-dir', default='./model_cache', help="Folder the exported models are cached in")
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames, args.num_frames)
+
+    print(f"{'backend':>9} {'mean [ms]':>10} {'p50 [ms]':>9} {'p95 [ms]':>9}")
+
+    for backend in args.backends:
+        model_path = export_model(args.model, backend, args.cache_dir)
+        segmenter = YoloSegmenter(model_path, 'cpu', 0.51, LABEL_MAPPING)
+        segmenter.warmup()
+
+        latencies = []
+        for frame in frames:
+            start = time.perf_counter()
+            segmenter.segment_image(frame)
+            latencies.append(time.perf_counter() - start)
+
+        latencies = np.array(latencies) * 1000
+        print(f"{backend:>9} {latencies.mean():>10.1f} {np.percentile(latencies, 50):>9.1f} {np.percentile(latencies, 95):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Throughput-vs-latency benchmark of batched YOLO segmentation on CPU.
+
+Run from the root of the repository, optionally with a folder of recorded frames:
+    python3 -m benchmarks.benchmark_batch_inference --frames /path/to/frames
+"""
+import argparse
+import glob
+import os
+import time
+
+import cv2
+import numpy as np
+
+from rob7_760_2024.LIB import YoloSegmenter
+
+
+LABEL_MAPPING = {
+    'person': 1, 'couch': 2, 'chair': 3, 'tv': 4, 'cup': 5, 'sink': 6, 'spoon': 7,
+    'vase': 8, 'refrigerator': 9, 'table': 10, 'sports ball': 11, 'cell phone': 12, 'bench': 13, 'bed': 14
+}
+
+
+def load_frames(frames_dir, num_frames):
+    """
+    Function for loading recorded frames from a folder, or generating random 640x480 frames if none is given.
+    """
+    if frames_dir:
+        paths = sorted(glob.glob(os.path.join(frames_dir, '*.png')) + glob.glob(os.path.join(frames_dir, '*.jpg')))
+        frames = [cv2.imread(path) for path in paths[:num_frames]]
+        if frames:
+            return frames
+
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, size=(480, 640, 3), dtype=np.uint8) for _ in range(num_frames)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='yolo11x-seg.pt', help="Segmentation model to benchmark")
+    parser.add_argument('--frames', default=None, help="Folder with recorded .png/.jpg frames")
+    parser.add_argument('--num-frames', type=int, default=32, help="Number of frames to run per batch size")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    segmenter = YoloSegmenter(args.model, 'cpu', 0.51, LABEL_MAPPING)
+    frames = load_frames(args.frames, args.num_frames)
+
+    # Warm up, so lazy initialization does not end up in the first measurement
+    segmenter.segment_batch(frames[:1])
+
+    print(f"{'batch':>6} {'latency [ms]':>13} {'per frame [ms]':>15} {'throughput [fps]':>17}")
+
+    for batch_size in args.batch_sizes:
+        batch_latencies = []
+        start = time.perf_counter()
+
+        for index in range(0, len(frames) - batch_size + 1, batch_size):
+            batch_start = time.perf_counter()
+            segmenter.segment_batch(frames[index:index + batch_size])
+            batch_latencies.append(time.perf_counter() - batch_start)
+
+        elapsed = time.perf_counter() - start
+        num_processed = len(batch_latencies) * batch_size
+
+        # Every frame in a batch is only available once the whole batch is done
+        latency = np.median(batch_latencies)
+        print(f"{batch_size:>6} {latency * 1000:>13.1f} {latency / batch_size * 1000:>15.1f} {num_processed / elapsed:>17.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Latency and detection count of the segmentation model at each inference resolution preset, for our labels.
+
+Run from the root of the repository, optionally with a folder of recorded frames:
+    python3 -m benchmarks.benchmark_imgsz --frames /path/to/frames
+"""
+import argparse
+import collections
+import time
+
+import numpy as np
+
+from rob7_760_2024.LIB import IMGSZ_PRESETS, YoloSegmenter
+from benchmarks.benchmark_batch_inference import LABEL_MAPPING, load_frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='yolo11x-seg.pt', help="Segmentation model to benchmark")
+    parser.add_argument('--frames', default=None, help="Folder with recorded .png/.jpg frames")
+    parser.add_argument('--num-frames', type=int, default=50, help="Number of frames to run per resolution")
+    parser.add_argument('--confidence', type=float, default=0.51)
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames, args.num_frames)
+    label_counts = {}
+
+    print(f"{'imgsz':>6} {'mean [ms]':>10} {'p95 [ms]':>9} {'detections':>11}")
+
+    for imgsz in IMGSZ_PRESETS:
+        segmenter = YoloSegmenter(args.model, 'cpu', args.confidence, LABEL_MAPPING, imgsz)
+        segmenter.warmup()
+
+        latencies = []
+        label_counts[imgsz] = collections.Counter()
+        for frame in frames:
+            start = time.perf_counter()
+            _, instances = segmenter.segment_image(frame)
+            latencies.append(time.perf_counter() - start)
+            label_counts[imgsz].update(instance['label'] for instance in instances)
+
+        latencies = np.array(latencies) * 1000
+        print(f"{imgsz:>6} {latencies.mean():>10.1f} {np.percentile(latencies, 95):>9.1f} {sum(label_counts[imgsz].values()):>11}")
+
+    # Number of instances found of each label, per resolution
+    print()
+    print(f"{'label':>12} " + " ".join(f"{imgsz:>6}" for imgsz in IMGSZ_PRESETS))
+    for label in LABEL_MAPPING:
+        print(f"{label:>12} " + " ".join(f"{label_counts[imgsz][label]:>6}" for imgsz in IMGSZ_PRESETS))
+
+
+if __name__ == "__main__":
+    main()
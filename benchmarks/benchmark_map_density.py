@@ -0,0 +1,67 @@
+"""
+Density of the accumulated semantic map for one object, through the decimation chain of both nodes: the per-object
+voxel grid of ImageSegmentationNode, the SAMPLING_PERCENTAGE sample and the DISTANCE_THRESHOLD check of
+SemanticPointcloudNode.
+
+A flat surface facing the camera is back-projected for a number of frames with a little depth noise, and the number
+of map points after the first and the last frame is printed for each voxel size and sampling percentage.
+
+Run from the root of the repository:
+    python3 -m benchmarks.benchmark_map_density
+"""
+import argparse
+
+import numpy as np
+
+from rob7_760_2024.LIB import LabeledPointStore, VoxelHashIndex, voxel_downsample
+
+
+def surface_points(rng, size, distance, fx, depth_noise):
+    """
+    Function for back-projecting every camera pixel on a square surface of 'size' metres at 'distance' metres.
+    """
+    pixels = int(size * fx / distance)
+    u, v = np.meshgrid(np.arange(pixels), np.arange(pixels))
+    z = distance + rng.normal(0.0, depth_noise, size=u.shape)
+
+    points = np.empty((u.size, 4), dtype=np.float32)
+    points[:, 0] = ((u.ravel() - pixels / 2) / fx) * z.ravel()
+    points[:, 1] = ((v.ravel() - pixels / 2) / fx) * z.ravel()
+    points[:, 2] = z.ravel()
+    points[:, 3] = 2
+    return points
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=float, default=0.5, help="Edge length of the surface in metres")
+    parser.add_argument('--distance', type=float, default=1.5, help="Distance of the surface to the camera in metres")
+    parser.add_argument('--fx', type=float, default=522.0, help="Focal length of the camera in pixels")
+    parser.add_argument('--depth-noise', type=float, default=0.005, help="Standard deviation of the depth noise in metres")
+    parser.add_argument('--frames', type=int, default=10, help="Number of frames to accumulate")
+    parser.add_argument('--distance-threshold', type=float, default=0.03, help="DISTANCE_THRESHOLD of SemanticPointcloudNode")
+    args = parser.parse_args()
+
+    print(f"{'voxel [m]':>9} {'sampling':>9} {'1 frame':>8} {f'{args.frames} frames':>10}")
+
+    for voxel_size, sampling_percentage in ((0.0, 0.2), (0.03, 0.2), (0.05, 0.2), (0.03, 1.0), (0.015, 1.0)):
+        rng = np.random.default_rng(0)
+        index = VoxelHashIndex(args.distance_threshold, LabeledPointStore())
+        counts = []
+
+        for _ in range(args.frames):
+            points = voxel_downsample(surface_points(rng, args.size, args.distance, args.fx, args.depth_noise), voxel_size)
+
+            # 'reduce_points' of SemanticPointcloudNode
+            if sampling_percentage < 1.0:
+                points = points[rng.choice(len(points), int(len(points) * sampling_percentage), replace=False)]
+
+            index.insert_if_far(points[:, :3], points[:, 3].astype(np.uint32))
+            counts.append(len(index))
+
+        label = f"{voxel_size:.3f}" if voxel_size > 0 else 'none'
+        print(f"{label:>9} {sampling_percentage:>9.1f} {counts[0]:>8} {counts[-1]:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Per-message cost of the proximity check of SemanticPointcloudNode as the accumulated map grows: the original
+per-point loop over all stored points against 'VoxelHashIndex.insert_if_far', which is what the node runs per message
+(bulk check against the map, check within the message and merging the accepted points). The bulk check alone
+('too_close') is listed as well.
+
+Run from the root of the repository:
+    python3 -m benchmarks.benchmark_point_index --max-points 1000000
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+
+from rob7_760_2024.LIB import LabeledPointStore, VoxelHashIndex
+
+
+def is_point_too_close(point, transformed_points, distance_threshold):
+    """
+    Function reproducing the original 'is_point_too_close' of SemanticPointcloudNode.
+    """
+    for f_point in transformed_points:
+        dist = math.sqrt((point['x'] - f_point['x']) ** 2 + (point['y'] - f_point['y']) ** 2 + (point['z'] - f_point['z']) ** 2)
+        if dist < distance_threshold:
+            return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-points', type=int, default=1000000, help="Size the accumulated map is grown to")
+    parser.add_argument('--message-points', type=int, default=2000, help="Points per incoming message")
+    parser.add_argument('--distance-threshold', type=float, default=0.03, help="DISTANCE_THRESHOLD of the node")
+    parser.add_argument('--naive-max-points', type=int, default=20000, help="Largest map the original loop is timed on")
+    parser.add_argument('--naive-sample', type=int, default=100, help="Points of a message the original loop is timed on")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    store = LabeledPointStore()
+    index = VoxelHashIndex(args.distance_threshold, store)
+    labels = np.zeros(args.message_points, dtype=np.uint32)
+
+    # Random points in a room sized volume, sparse enough for most of them to be accepted
+    def make_message():
+        return rng.uniform((-10.0, -10.0, 0.0), (10.0, 10.0, 3.0), size=(args.message_points, 3)).astype(np.float32)
+
+    checkpoints = [size for size in (1000, 10000, 100000, 1000000) if size <= args.max_points]
+
+    print(f"{'map points':>10} {'check [ms/msg]':>15} {'insert [ms/msg]':>16} {'insert [us/pt]':>15} {'loop [us/pt]':>13}")
+
+    for checkpoint in checkpoints:
+        while len(index) < checkpoint:
+            index.insert_if_far(make_message(), labels)
+
+        map_size = len(index)
+        message = make_message()
+        start = time.perf_counter()
+        for _ in range(5):
+            index.too_close(message)
+        check_time = (time.perf_counter() - start) / 5
+
+        loop_column = '-'
+        if map_size <= args.naive_max_points:
+            stored = [{'x': x, 'y': y, 'z': z} for x, y, z in store.xyz.tolist()]
+            sample = [{'x': x, 'y': y, 'z': z} for x, y, z in message[:args.naive_sample].tolist()]
+            start = time.perf_counter()
+            for point in sample:
+                is_point_too_close(point, stored, args.distance_threshold)
+            loop_column = f"{(time.perf_counter() - start) / len(sample) * 1e6:.1f}"
+
+        # Every insert grows the map, so each run gets a fresh message
+        messages = [make_message() for _ in range(5)]
+        start = time.perf_counter()
+        for message in messages:
+            index.insert_if_far(message, labels)
+        insert_time = (time.perf_counter() - start) / len(messages)
+
+        print(f"{map_size:>10} {check_time * 1000:>15.2f} {insert_time * 1000:>16.2f} {insert_time / args.message_points * 1e6:>15.2f} "
+              f"{loop_column:>13}")
+
+
+if __name__ == "__main__":
+    main()
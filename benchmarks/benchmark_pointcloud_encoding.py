@@ -0,0 +1,50 @@
+"""
+Micro-benchmark of the PointCloud2 payload encoding: per-point 'struct.pack' against the structured array encoder.
+
+Run from the root of the repository:
+    python3 -m benchmarks.benchmark_pointcloud_encoding
+"""
+import struct
+import timeit
+
+import numpy as np
+
+from rob7_760_2024.LIB import encode_labeled_points
+
+
+def struct_encode(labeled_points_3d):
+    """
+    Function reproducing the original per-point encoding of 'publish_pointcloud'.
+    """
+    pointcloud_data = [struct.pack('fffI', x, y, z, int(label_id)) for x, y, z, label_id in labeled_points_3d]
+    return b''.join(pointcloud_data)
+
+
+def make_points(num_points, seed=0):
+    """
+    Function for generating random labeled camera-frame points.
+    """
+    rng = np.random.default_rng(seed)
+    points = np.empty((num_points, 4), dtype=np.float32)
+    points[:, :3] = rng.uniform(-3.0, 3.0, size=(num_points, 3))
+    points[:, 3] = rng.integers(1, 15, size=num_points)
+    return points
+
+
+def main():
+    print(f"{'points':>8} {'struct [ms]':>12} {'numpy [ms]':>12} {'speedup':>8}")
+
+    for num_points in (1000, 10000, 100000):
+        points = make_points(num_points)
+
+        # Both encoders must produce the exact same bytes
+        assert struct_encode(points) == encode_labeled_points(points).tobytes()
+
+        struct_time = min(timeit.repeat(lambda: struct_encode(points), number=3, repeat=3)) / 3
+        numpy_time = min(timeit.repeat(lambda: encode_labeled_points(points), number=20, repeat=5)) / 20
+
+        print(f"{num_points:>8} {struct_time * 1000:>12.3f} {numpy_time * 1000:>12.3f} {struct_time / numpy_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Offline accuracy report of a quantized segmentation model against the full precision model, on the same recorded frames.
+
+Instances of the quantized model are matched to the full precision instances of the same label by mask IoU. The report
+lists per-label recall (share of full precision instances the quantized model also finds) and the mean mask IoU of the
+matched instances, next to the latency of both models.
+
+Run from the root of the repository with a folder of recorded frames:
+    python3 -m benchmarks.report_quantization_accuracy --frames /path/to/frames --backend onnx --quantization int8_static
+"""
+import argparse
+import collections
+import time
+
+import numpy as np
+
+from rob7_760_2024.LIB import INFERENCE_BACKENDS, QUANTIZATION_MODES, YoloSegmenter, align_instances_to_depth, export_model, read_frames
+from benchmarks.benchmark_batch_inference import LABEL_MAPPING
+
+
+def run_model(model_path, frames, confidence, imgsz):
+    """
+    Function for segmenting every frame with a model, returning the instances (masks in image pixels) and latencies.
+    """
+    segmenter = YoloSegmenter(model_path, 'cpu', confidence, LABEL_MAPPING, imgsz)
+    segmenter.warmup(*frames[0].shape[:2])
+
+    frame_instances = []
+    latencies = []
+    for frame in frames:
+        start = time.perf_counter()
+        _, instances = segmenter.segment_image(frame)
+        latencies.append(time.perf_counter() - start)
+        frame_instances.append(align_instances_to_depth(instances, frame.shape[:2]))
+
+    return frame_instances, np.array(latencies) * 1000
+
+
+def full_frame_mask(instance, image_shape):
+    """
+    Function for pasting an instance's bounding box mask into an image sized mask.
+    """
+    mask = np.zeros(image_shape[:2], dtype=bool)
+    x_min, y_min, x_max, y_max = instance['bbox']
+    mask[y_min:y_max, x_min:x_max] = instance['mask']
+    return mask
+
+
+def match_instances(reference_instances, quantized_instances, image_shape, iou_threshold):
+    """
+    Function for greedily matching instances of the same label, highest mask IoU first.
+
+    Returns:
+        list: (reference index, quantized index, mask IoU) of every match above the IoU threshold.
+    """
+    reference_masks = [full_frame_mask(instance, image_shape) for instance in reference_instances]
+    quantized_masks = [full_frame_mask(instance, image_shape) for instance in quantized_instances]
+
+    candidates = []
+    for i, (reference, reference_mask) in enumerate(zip(reference_instances, reference_masks)):
+        for j, (quantized, quantized_mask) in enumerate(zip(quantized_instances, quantized_masks)):
+            if reference['label'] != quantized['label']:
+                continue
+            union = np.count_nonzero(reference_mask | quantized_mask)
+            iou = np.count_nonzero(reference_mask & quantized_mask) / union if union else 0.0
+            if iou >= iou_threshold:
+                candidates.append((iou, i, j))
+
+    matches = []
+    used_reference, used_quantized = set(), set()
+    for iou, i, j in sorted(candidates, reverse=True):
+        if i in used_reference or j in used_quantized:
+            continue
+        used_reference.add(i)
+        used_quantized.add(j)
+        matches.append((i, j, iou))
+
+    return matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='yolo11x-seg.pt', help="PyTorch segmentation model to quantize")
+    parser.add_argument('--frames', required=True, help="Folder with recorded .png/.jpg frames to evaluate on")
+    parser.add_argument('--num-frames', type=int, default=200, help="Number of frames to evaluate on")
+    parser.add_argument('--backend', default='onnx', choices=[backend for backend in INFERENCE_BACKENDS if backend != 'torch'])
+    parser.add_argument('--quantization', default='int8_dynamic', choices=[mode for mode in QUANTIZATION_MODES if mode != 'none'])
+    parser.add_argument('--calibration-frames', default=None, help="Folder with calibration frames for 'int8_static', defaults to --frames")
+    parser.add_argument('--imgsz', type=int, default=640, help="Inference resolution")
+    parser.add_argument('--confidence', type=float, default=0.51, help="Confidence threshold of both models")
+    parser.add_argument('--iou-threshold', type=float, default=0.5, help="Minimum mask IoU for two instances to match")
+    parser.add_argument('--cache-dir', default='./model_cache', help="Folder the exported models are cached in")
+    args = parser.parse_args()
+
+    frames = read_frames(args.frames, args.num_frames)
+    if not frames:
+        parser.error(f"No frames found in '{args.frames}'")
+
+    # The full precision reference runs on the same backend, so the report only shows the effect of quantization
+    reference_path = export_model(args.model, args.backend, args.cache_dir, imgsz=args.imgsz)
+    quantized_path = export_model(args.model, args.backend, args.cache_dir, imgsz=args.imgsz, quantization=args.quantization,
+                                  calibration_dir=args.calibration_frames or args.frames)
+
+    reference_results, reference_latencies = run_model(reference_path, frames, args.confidence, args.imgsz)
+    quantized_results, quantized_latencies = run_model(quantized_path, frames, args.confidence, args.imgsz)
+
+    reference_counts = collections.Counter()
+    quantized_counts = collections.Counter()
+    matched_counts = collections.Counter()
+    matched_ious = collections.defaultdict(list)
+
+    for frame, reference_instances, quantized_instances in zip(frames, reference_results, quantized_results):
+        reference_counts.update(instance['label'] for instance in reference_instances)
+        quantized_counts.update(instance['label'] for instance in quantized_instances)
+        for i, _, iou in match_instances(reference_instances, quantized_instances, frame.shape, args.iou_threshold):
+            label = reference_instances[i]['label']
+            matched_counts[label] += 1
+            matched_ious[label].append(iou)
+
+    print(f"{len(frames)} frames, {args.backend} {args.quantization} vs full precision, match IoU >= {args.iou_threshold}\n")
+    print(f"{'label':>13} {'reference':>10} {'quantized':>10} {'recall':>7} {'mask IoU':>9}")
+
+    for label in sorted(reference_counts | quantized_counts):
+        recall = matched_counts[label] / reference_counts[label] if reference_counts[label] else float('nan')
+        mean_iou = np.mean(matched_ious[label]) if matched_ious[label] else float('nan')
+        print(f"{label:>13} {reference_counts[label]:>10} {quantized_counts[label]:>10} {recall:>7.3f} {mean_iou:>9.3f}")
+
+    total_reference = sum(reference_counts.values())
+    all_ious = [iou for ious in matched_ious.values() for iou in ious]
+    total_recall = sum(matched_counts.values()) / total_reference if total_reference else float('nan')
+    total_iou = np.mean(all_ious) if all_ious else float('nan')
+    print(f"{'all':>13} {total_reference:>10} {sum(quantized_counts.values()):>10} {total_recall:>7.3f} {total_iou:>9.3f}\n")
+
+    print(f"{'model':>15} {'mean [ms]':>10} {'p50 [ms]':>9} {'p95 [ms]':>9}")
+    for name, latencies in (('full precision', reference_latencies), (args.quantization, quantized_latencies)):
+        print(f"{name:>15} {latencies.mean():>10.1f} {np.percentile(latencies, 50):>9.1f} {np.percentile(latencies, 95):>9.1f}")
+    print(f"\nSpeedup: {reference_latencies.mean() / quantized_latencies.mean():.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,7 @@ def generate_launch_description():
         'frame_id': 'base_link',
         'odom_frame_id': 'odom',
         'use_sim_time': True,
+        # Must match MIN_DEPTH/MAX_DEPTH of ImageSegmentationNode in 'settings.json' (checked by test/test_settings.py)
         'RGBD/MaxDepth': 8.0,
         'RGBD/MinDepth': 0.6,
         'imu_frame_id':'base_imu_link',
@@ -1,4 +1,4 @@
-from rob7_760_2024.LIB import JSON_Handler
+from rob7_760_2024.LIB import JSON_Handler, LabeledPointStore, read_labeled_points
 
 import rclpy
 from rclpy.node import Node
@@ -30,9 +30,12 @@ class GetCentroidsNode(Node):
         self.logger.error("Hello world!")
         self.logger.fatal("Hello world!")
         
-        # Subscribe to the 3D points topic from object_det_cloud
+        # Subscribe to the 3D points topic from object_det_cloud. Full snapshots replace the stored points,
+        # deltas (points added since the previous publish) are appended to them
         self.point_sub = self.create_subscription(
             PointCloud2, '/transformed_points', self.transformed_points_callback, 10)
+        self.point_delta_sub = self.create_subscription(
+            PointCloud2, '/transformed_points/delta', self.transformed_points_delta_callback, 10)
 
         # Subscribe to the obstacles cloud topic from SegmentationNode
         self.timestamp_sub = self.create_subscription(
@@ -41,21 +44,31 @@ class GetCentroidsNode(Node):
         # Publisher for the filtered points as PointCloud2
         self.point_cloud_pub = self.create_publisher(PointCloud2, '/centroids', 10)
 
-        # Lists to store points from the topics
-        self.transformed_points = []
+        # Stores for the points from the topics
+        self.transformed_points = LabeledPointStore()
         self.cloud_obstacles = []
 
         self.logger.info("GetCentroids Node initialized.")
 
     def transformed_points_callback(self, msg):
         """
-        Callback to handle transformed points.
-        Extracts x, y, z, and label_id from the incoming PointCloud2 message.
+        Callback to handle a full snapshot of transformed points.
+        Extracts x, y, z, and label_id from the incoming PointCloud2 message, replacing the stored points.
         """
-        self.transformed_points = list(pc2.read_points(
-            msg, field_names=["x", "y", "z", "label"], skip_nans=True))
+        xyz, labels = read_labeled_points(msg, skip_nans=True)
+        self.transformed_points.clear()
+        self.transformed_points.append(xyz, labels)
         self.logger.debug(f"Received {len(self.transformed_points)} transformed points.")
 
+    def transformed_points_delta_callback(self, msg):
+        """
+        Callback to handle transformed points added since the previous publish.
+        Extracts x, y, z, and label_id from the incoming PointCloud2 message, appending them to the stored points.
+        """
+        xyz, labels = read_labeled_points(msg, skip_nans=True)
+        self.transformed_points.append(xyz, labels)
+        self.logger.debug(f"Received {len(xyz)} new transformed points, {len(self.transformed_points)} in total.")
+
     def cloud_obstacles_callback(self, msg):
         """
         Callback to handle cloud obstacles.
@@ -86,8 +99,7 @@ class GetCentroidsNode(Node):
 
         # Filter transformed points based on proximity to obstacles
         filtered_points = []
-        for point in self.transformed_points:
-            x, y, z, label_id = point
+        for (x, y, z), label_id in zip(self.transformed_points.xyz.tolist(), self.transformed_points.labels.tolist()):
             distances = np.linalg.norm(obstacle_array - np.array([x, y, z]), axis=1)
             if np.any(distances < self.DISTANCE_THRESHOLD):
                 filtered_points.append((x, y, z, label_id))
@@ -154,10 +166,6 @@ class GetCentroidsNode(Node):
         The non-merged centroids will be retained.
 
         Args:
-
-def generate_launch_description():
-
-    param = [{
             centroids (list): List of centroids [(x, y, z, label_id), ...].
             merge_threshold (float): Distance threshold for merging centroids (meters).
             obstacle_threshold (float): Distance threshold for checking if the merged centroid is near an obstacle.
@@ -1,25 +1,117 @@
-from rob7_760_2024.LIB import JSON_Handler
+from rob7_760_2024.LIB import JSON_Handler, RayLookupTable, StampedMessageBuffer, YoloSegmenter, InferenceWorkerPool, AdaptiveFrameScheduler, KeyframeSelector, MaskPropagator
+from rob7_760_2024.LIB import TwoTierSegmenter
+from rob7_760_2024.LIB import IMGSZ_PRESETS, align_instances_to_depth, back_project_instances, encode_labeled_points, encode_object_summaries, export_model, stamp_to_nanoseconds
+from rob7_760_2024.LIB import cap_points, depth_msg_to_metres, summarize_object, voxel_downsample
 
 import rclpy
 from rclpy.node import Node
 from sensor_msgs.msg import Image, CameraInfo, PointCloud2, PointField
 from cv_bridge import CvBridge
 import sensor_msgs_py.point_cloud2 as pc2
-from std_msgs.msg import Bool
+from std_msgs.msg import Bool, String
+from geometry_msgs.msg import PoseWithCovarianceStamped
 
 import numpy as np
 import cv2
-from ultralytics import YOLO
 import torch
-import struct
-import math
+import functools
+import json
+
+
+class CameraStream:
+    """
+    Class holding the per-camera state of the pipeline: topics, output frame, depth synchronizer, intrinsics cache,
+    keyframe selector and (in cascade mode) mask propagator. All cameras share the node's inference pool.
+    """
+
+    def __init__(self, namespace, frame_id, sync_tolerance, depth_buffer_size, keyframe_selector, mask_propagator=None):
+
+        self.namespace = namespace.rstrip('/')
+        self.frame_id = frame_id
+
+        self.rgb_topic = f"{self.namespace}/rgb/image_raw"
+        self.depth_topic = f"{self.namespace}/depth_registered/image_raw"
+        self.camera_info_topic = f"{self.namespace}/rgb/camera_info"
+
+        # Ring buffer of raw depth messages, paired with RGB frames by header stamp
+        self.depth_synchronizer = StampedMessageBuffer(sync_tolerance, depth_buffer_size)
+        self.pending_rgb_msg = None  # RGB frame waiting for its depth frame to arrive
+
+        self.camera_matrix = None  # Placeholder for camera intrinsic matrix
+        self.ray_table = None  # Cached per-pixel unit rays, rebuilt only when the intrinsics change
+        self.depth_ray_table = None  # The same rays at the depth image resolution, if it differs from the RGB image
+        self.camera_info_received = False  # Flag to ensure camera info is received
+
+        self.keyframe_selector = keyframe_selector
+        self.mask_propagator = mask_propagator
+
+        self.rgb_subscription = None
+        self.depth_subscription = None
+        self.camera_info_subscription = None
+
+
+    def ray_table_for(self, depth_shape):
+        """
+        Function for getting the ray table matching the resolution of a depth image, built once per resolution.
+        """
+        height, width = depth_shape[:2]
+        if self.depth_ray_table is None or (self.depth_ray_table.height, self.depth_ray_table.width) != (height, width):
+            self.depth_ray_table = self.ray_table.for_resolution(width, height)
+        return self.depth_ray_table
+
 
 class ImageSegmentationNode(Node):
-    def __init__(self,  confidence, frame_skipped):
+    def __init__(self,  confidence, sync_tolerance, depth_buffer_size,
+                 inference_pool_type, inference_workers, inference_queue_size, drop_policy,
+                 batch_mode, max_batch_size, max_batch_wait,
+                 model_path, inference_backend, model_cache_dir,
+                 target_rate, cpu_budget, cost_smoothing, metrics_period,
+                 imgsz, voxel_size, voxel_size_per_label, max_points_per_object,
+                 min_depth, max_depth,
+                 keyframe_translation, keyframe_rotation, keyframe_refresh_period,
+                 cascade_mode, cascade_interval, cascade_change_threshold,
+                 two_tier_mode, primary_model_path, escalation_band,
+                 quantization, calibration_dir, warmup_timeout,
+                 publish_dense_cloud, cameras):
 
         
         self.CONFIDENCE = confidence
-        self.FRAME_SKIPPED = frame_skipped
+        self.SYNC_TOLERANCE = sync_tolerance
+        self.DEPTH_BUFFER_SIZE = depth_buffer_size
+        self.INFERENCE_POOL_TYPE = inference_pool_type
+        self.INFERENCE_WORKERS = inference_workers
+        self.INFERENCE_QUEUE_SIZE = inference_queue_size
+        self.DROP_POLICY = drop_policy
+        self.BATCH_MODE = batch_mode
+        self.MAX_BATCH_SIZE = max_batch_size
+        self.MAX_BATCH_WAIT = max_batch_wait
+        self.MODEL_PATH = model_path
+        self.INFERENCE_BACKEND = inference_backend
+        self.MODEL_CACHE_DIR = model_cache_dir
+        self.TARGET_RATE = target_rate
+        self.CPU_BUDGET = cpu_budget
+        self.COST_SMOOTHING = cost_smoothing
+        self.METRICS_PERIOD = metrics_period
+        self.IMGSZ = imgsz
+        self.VOXEL_SIZE = voxel_size
+        self.VOXEL_SIZE_PER_LABEL = voxel_size_per_label
+        self.MAX_POINTS_PER_OBJECT = max_points_per_object
+        self.MIN_DEPTH = min_depth
+        self.MAX_DEPTH = max_depth
+        self.KEYFRAME_TRANSLATION = keyframe_translation
+        self.KEYFRAME_ROTATION = keyframe_rotation
+        self.KEYFRAME_REFRESH_PERIOD = keyframe_refresh_period
+        self.CASCADE_MODE = cascade_mode
+        self.CASCADE_INTERVAL = cascade_interval
+        self.CASCADE_CHANGE_THRESHOLD = cascade_change_threshold
+        self.TWO_TIER_MODE = two_tier_mode
+        self.PRIMARY_MODEL_PATH = primary_model_path
+        self.ESCALATION_BAND = escalation_band
+        self.QUANTIZATION = quantization
+        self.CALIBRATION_DIR = calibration_dir
+        self.WARMUP_TIMEOUT = warmup_timeout
+        self.PUBLISH_DENSE_CLOUD = publish_dense_cloud
+        self.CAMERAS = cameras
         
         
         # Initializing the 'Node' class, from which this class is inheriting, with argument 'node_name'.
@@ -35,32 +127,32 @@ class ImageSegmentationNode(Node):
         
         self.trigger = False
 
-        # Frame counters to process every 10th frame (reduces computational load)
-        self.rgb_frame_counter = 0
-        self.depth_frame_counter = 0
-
-        # Subscriptions for RGB, depth images, and camera info
-        self.rgb_subscription = self.create_subscription(
-            Image,
-            '/head_front_camera/rgb/image_raw',  # Topic for raw RGB images
-            self.rgb_callback,  # Callback function to process RGB images
-            10  # Queue size
-        )
-        self.depth_subscription = self.create_subscription(
-            Image,
-            '/head_front_camera/depth_registered/image_raw',  # Topic for raw depth images
-            self.depth_callback,  # Callback function to process depth images
-            10  # Queue size
-        )
-        self.camera_info_subscription = self.create_subscription(
-            CameraInfo,
-            '/head_front_camera/rgb/camera_info',  # Topic for camera info (intrinsics)
-            self.camera_info_callback,  # Callback to process camera intrinsics
-            10  # Queue size
-        )
+        # One stream per camera, each with its own synchronizer, intrinsics and keyframe selection.
+        # In cascade mode, frames between full segmentations are served by propagating the last instances with optical flow
+        self.cameras = []
+        for camera in self.CAMERAS:
+            keyframe_selector = KeyframeSelector(self.KEYFRAME_TRANSLATION, self.KEYFRAME_ROTATION, self.KEYFRAME_REFRESH_PERIOD)
+            mask_propagator = MaskPropagator(self.CASCADE_INTERVAL, self.CASCADE_CHANGE_THRESHOLD) if self.CASCADE_MODE else None
+            self.cameras.append(CameraStream(camera["NAMESPACE"], camera["FRAME_ID"], self.SYNC_TOLERANCE, self.DEPTH_BUFFER_SIZE,
+                                             keyframe_selector, mask_propagator))
+
+        # The RGB and depth subscriptions are only attached once the trigger fires, so an idle node decodes no images.
+        # Camera info is cheap and subscribed while idle, so the ray tables are ready before the first frame
+        for camera in self.cameras:
+            camera.camera_info_subscription = self.create_subscription(
+                CameraInfo,
+                camera.camera_info_topic,  # Topic for camera info (intrinsics)
+                functools.partial(self.camera_info_callback, camera),  # Callback to process camera intrinsics
+                10  # Queue size
+            )
+            self.logger.info(f"Camera '{camera.namespace}' publishing in frame '{camera.frame_id}'")
 
         self.trigger_subscriber = self.create_subscription(Bool, '/trigger3', self.trigger_callback, 10)
 
+        # Robot pose, used to only segment frames after the robot moved (same topic as MainNode)
+        self.PoseWithCovarianceStamped_subscription = self.create_subscription(
+            PoseWithCovarianceStamped, '/localization_pose', self.PoseWithCovarianceStamped_callback, 10)
+
         # Publisher for 3D points as a PointCloud2 message
         self.pointcloud_pub = self.create_publisher(
             PointCloud2,  # Publish as PointCloud2 message
@@ -68,14 +160,17 @@ class ImageSegmentationNode(Node):
             10  # Queue size
         )
 
+        # Publisher for one summary per detected object (centroid, extent, confidence, label and point count) as a PointCloud2 message
+        self.summary_pub = self.create_publisher(PointCloud2, '/object_detected/summary', 10)
+
+        # Publisher for the frame scheduler metrics as a JSON string
+        self.metrics_pub = self.create_publisher(String, '/object_detected/metrics', 10)
+
         # Initialize utilities
         self.bridge = CvBridge()  # For converting ROS Image messages to OpenCV
         self.device = "cuda" if torch.cuda.is_available() else "cpu"  # Select computation device
         self.logger.info(f"Using device: {self.device}")  # Log the chosen device
-        self.model = YOLO("yolo11x-seg.pt", verbose=False)  # Load the YOLO model for segmentation
-        self.camera_matrix = None  # Placeholder for camera intrinsic matrix
-        self.depth_image = None  # Placeholder for the latest depth image
-        self.camera_info_received = False  # Flag to ensure camera info is received
+        self.rng = np.random.default_rng()  # Random generator for capping the number of points per object
 
         # Mapping object labels to unique IDs for easier handling
         self.label_mapping = {
@@ -95,6 +190,65 @@ class ImageSegmentationNode(Node):
             'bed': 14
         }
 
+        if self.IMGSZ not in IMGSZ_PRESETS:
+            raise ValueError(f"IMGSZ must be one of {IMGSZ_PRESETS}, got {self.IMGSZ}")
+
+        # Export the model to the chosen backend once (cached on disk), before any worker loads it
+        model_path = export_model(self.MODEL_PATH, self.INFERENCE_BACKEND, self.MODEL_CACHE_DIR, imgsz=self.IMGSZ, dynamic=self.BATCH_MODE,
+                                  quantization=self.QUANTIZATION, calibration_dir=self.CALIBRATION_DIR)
+        self.logger.info(f"Using '{self.INFERENCE_BACKEND}' inference backend with model '{model_path}' at imgsz {self.IMGSZ}, "
+                         f"quantization '{self.QUANTIZATION}'")
+
+        # Pool of YOLO replicas running inference off the rclpy callback thread, each warmed up before the first frame.
+        # The pool is shared by all cameras, so frames of different cameras are batched together
+        if self.TWO_TIER_MODE:
+            # Light primary model on every frame, MODEL_PATH only on frames where the primary model is uncertain
+            primary_model_path = export_model(self.PRIMARY_MODEL_PATH, self.INFERENCE_BACKEND, self.MODEL_CACHE_DIR, imgsz=self.IMGSZ, dynamic=self.BATCH_MODE,
+                                              quantization=self.QUANTIZATION, calibration_dir=self.CALIBRATION_DIR)
+            self.logger.info(f"Two-tier mode: primary model '{primary_model_path}', escalation band {self.ESCALATION_BAND}")
+            segmenter_factory = functools.partial(TwoTierSegmenter, primary_model_path, model_path, self.device, self.CONFIDENCE,
+                                                  self.label_mapping, self.IMGSZ, self.ESCALATION_BAND)
+        else:
+            segmenter_factory = functools.partial(YoloSegmenter, model_path, self.device, self.CONFIDENCE, self.label_mapping, self.IMGSZ)
+
+        if self.BATCH_MODE:
+            # Collect frames into batches, so the model runs once per batch instead of once per frame
+            self.inference_pool = InferenceWorkerPool(segmenter_factory, self.INFERENCE_WORKERS, self.INFERENCE_POOL_TYPE,
+                                                      self.INFERENCE_QUEUE_SIZE, self.DROP_POLICY,
+                                                      self.MAX_BATCH_SIZE, self.MAX_BATCH_WAIT)
+        else:
+            self.inference_pool = InferenceWorkerPool(segmenter_factory, self.INFERENCE_WORKERS, self.INFERENCE_POOL_TYPE,
+                                                      self.INFERENCE_QUEUE_SIZE, self.DROP_POLICY)
+        self.logger.info(f"Inference pool: {self.INFERENCE_WORKERS} {self.INFERENCE_POOL_TYPE} worker(s), policy '{self.DROP_POLICY}', "
+                         f"batch size {self.inference_pool.MAX_BATCH_SIZE}")
+
+        # Wait while idle for every replica to be loaded and warmed up, so the first frame after the trigger runs at steady-state latency
+        if self.inference_pool.wait_until_ready(self.WARMUP_TIMEOUT):
+            self.logger.info("Inference pool warmed up.")
+        else:
+            for error in self.inference_pool.load_errors:
+                self.logger.error(f"Failed to load segmenter replica: {error}")
+
+            if self.inference_pool.failed_workers == self.inference_pool.NUM_WORKERS:
+                self.inference_pool.shutdown()
+                raise RuntimeError("No segmenter replica could be loaded, see the errors above")
+            elif self.inference_pool.failed_workers > 0:
+                self.logger.warn(f"Only {self.inference_pool.ready_workers} of {self.inference_pool.NUM_WORKERS} segmenter replicas loaded, "
+                                 f"running with reduced throughput.")
+            else:
+                self.logger.warn(f"Inference pool not warmed up after {self.WARMUP_TIMEOUT} s, the first frames may be slow.")
+
+        # Scheduler deciding which frames to process over all cameras, based on the measured cost per frame
+        self.frame_scheduler = AdaptiveFrameScheduler(self.TARGET_RATE, self.CPU_BUDGET, self.COST_SMOOTHING,
+                                                      max_in_flight=self.INFERENCE_WORKERS * self.inference_pool.MAX_BATCH_SIZE)
+
+        # Timer collecting finished inference results for back-projection and publishing, only running while triggered
+        self.inference_result_timer = self.create_timer(0.01, self.inference_result_callback)
+        self.inference_result_timer.cancel()
+
+        # Timer periodically publishing the achieved processing rate and drop counts
+        self.metrics_timer = self.create_timer(self.METRICS_PERIOD, self.metrics_timer_callback)
+
         self.logger.fatal("Waiting for trigger.")
 
 
@@ -103,125 +257,279 @@ class ImageSegmentationNode(Node):
         
         if msg.data == True:
             self.trigger = True
+            self.attach_image_subscriptions()
+        else:
+            self.trigger = False
+            self.detach_image_subscriptions()
+
+    def attach_image_subscriptions(self):
+        """Subscribe to the RGB and depth images of every camera when leaving the idle state."""
+        if self.inference_result_timer.is_canceled():
+            self.inference_result_timer.reset()
+
+        for camera in self.cameras:
+            if camera.rgb_subscription is not None:
+                continue
+
+            # Subscriptions for RGB and depth images
+            camera.rgb_subscription = self.create_subscription(
+                Image,
+                camera.rgb_topic,  # Topic for raw RGB images
+                functools.partial(self.rgb_callback, camera),  # Callback function to process RGB images
+                10  # Queue size
+            )
+            camera.depth_subscription = self.create_subscription(
+                Image,
+                camera.depth_topic,  # Topic for raw depth images
+                functools.partial(self.depth_callback, camera),  # Callback function to process depth images
+                10  # Queue size
+            )
+            self.logger.info(f"Attached RGB and depth subscriptions of camera '{camera.namespace}'.")
+
+    def detach_image_subscriptions(self):
+        """Unsubscribe from the RGB and depth images of every camera when going back to the idle state."""
+        # The result timer stops once the frames still in the pool are published, so the node does not poll while idle
+        if self.frame_scheduler.in_flight == 0:
+            self.inference_result_timer.cancel()
+
+        for camera in self.cameras:
+            if camera.rgb_subscription is None:
+                continue
+
+            self.destroy_subscription(camera.rgb_subscription)
+            self.destroy_subscription(camera.depth_subscription)
+            camera.rgb_subscription = None
+            camera.depth_subscription = None
 
-    def rgb_callback(self, msg):
-        """Callback to process incoming RGB image messages."""
+            # Frames buffered before going idle are stale once the node is triggered again
+            camera.depth_synchronizer = StampedMessageBuffer(self.SYNC_TOLERANCE, self.DEPTH_BUFFER_SIZE)
+            camera.pending_rgb_msg = None
+            self.logger.info(f"Detached RGB and depth subscriptions of camera '{camera.namespace}', node is idle.")
+
+    def rgb_callback(self, camera, msg):
+        """Callback to process incoming RGB image messages of a camera."""
         
         if self.trigger:
-            self.rgb_frame_counter += 1  # Increment the frame counter
+            # Skip frames taken while the robot has barely moved since the camera's last processed frame
+            if not camera.keyframe_selector.is_keyframe():
+                return
 
-            # Skip processing for all but every 10th frame to reduce load
-            if self.rgb_frame_counter % self.FRAME_SKIPPED != 0:
+            # Only process the frame once the pipeline has capacity and the rate and CPU budget allow it
+            if not self.frame_scheduler.should_process():
                 return
 
-            # Periodically reset the frame counter to avoid overflow
-            if self.rgb_frame_counter >= 10000:
-                self.rgb_frame_counter = 0
+            # Ensure camera info is available
+            if not camera.camera_info_received:
+                self.logger.warn(f"CameraInfo of camera '{camera.namespace}' not received yet, skipping processing.")
+                return
 
-            # Ensure camera info and depth image are available
-            if not self.camera_info_received or self.depth_image is None:
-                self.logger.warn("CameraInfo or Depth Image not received yet, skipping processing.")
+            # Pair the RGB frame with the depth frame closest in time
+            depth_msg = camera.depth_synchronizer.match(msg.header.stamp)
+            if depth_msg is None:
+                # The matching depth frame may still be on its way, retry when it arrives
+                camera.pending_rgb_msg = msg
                 return
 
-            # Convert ROS RGB image message to OpenCV format
-            rgb_image = self.bridge.imgmsg_to_cv2(msg, desired_encoding='bgr8')
+            camera.pending_rgb_msg = None
+            self.submit_frame(camera, msg, depth_msg)
 
-            # Reference the latest depth image
-            depth_image = self.depth_image
+    def PoseWithCovarianceStamped_callback(self, msg):
+        """Callback to store the latest robot pose for keyframe selection."""
+        for camera in self.cameras:
+            camera.keyframe_selector.update_pose(msg.pose.pose)
 
-            # Perform segmentation to get labeled masks
-            _, labeled_masks = self.segment_image(rgb_image)
+    def depth_callback(self, camera, msg):
+        """Callback to buffer incoming depth image messages of a camera until they are paired with an RGB frame."""
+        camera.depth_synchronizer.add(msg)
 
-            # Compute 3D positions for detected objects
-            labeled_points_3d = self.find_3d_positions(labeled_masks, depth_image)
+        if camera.pending_rgb_msg is None:
+            return
 
-            # Publish the 3D points as a PointCloud2 message
-            self.publish_pointcloud(labeled_points_3d, msg.header.stamp)
+        depth_msg = camera.depth_synchronizer.match(camera.pending_rgb_msg.header.stamp)
+        if depth_msg is not None:
+            rgb_msg = camera.pending_rgb_msg
+            camera.pending_rgb_msg = None
 
-    def depth_callback(self, msg):
-        """Callback to process incoming depth image messages."""
-        self.depth_frame_counter += 1  # Increment the frame counter
+            # The frame was admitted when it arrived, but other frames may have taken the capacity while it waited for depth
+            if not self.frame_scheduler.has_capacity():
+                self.logger.debug(f"No capacity left for pending RGB frame of camera '{camera.namespace}', skipping it.")
+                self.frame_scheduler.frame_skipped()
+                return
 
-        # Skip processing for all but every 10th frame to reduce load
-        if self.depth_frame_counter % self.FRAME_SKIPPED  != 0:
-            return
+            self.submit_frame(camera, rgb_msg, depth_msg)
+
+        # Give up on the pending RGB frame once depth frames newer than the tolerance are arriving
+        elif (camera.depth_synchronizer.newest_stamp_ns() - stamp_to_nanoseconds(camera.pending_rgb_msg.header.stamp)
+              > camera.depth_synchronizer.tolerance_ns):
+            self.logger.debug(f"No depth frame within tolerance of pending RGB frame of camera '{camera.namespace}', dropping it.")
+            camera.pending_rgb_msg = None
+
+    def submit_frame(self, camera, rgb_msg, depth_msg):
+        """Hand a synchronized RGB/depth pair to the inference pool, or to the camera's mask propagator in cascade mode."""
+        # Convert ROS RGB image message to OpenCV format
+        rgb_image = self.bridge.imgmsg_to_cv2(rgb_msg, desired_encoding='bgr8')
+
+        # The depth message travels along with the frame and is only converted once inference is done
+        context = {
+            'camera': camera,
+            'stamp': rgb_msg.header.stamp,
+            'depth_msg': depth_msg,
+            'start_time': self.frame_scheduler.frame_started(),
+        }
 
-        # Periodically reset the frame counter to avoid overflow
-        if self.depth_frame_counter >= 10000:
-            self.depth_frame_counter = 0
+        if camera.mask_propagator is not None:
+            gray = camera.mask_propagator.to_gray(rgb_image)
+
+            # Cheap path: move the instances of the last full segmentation into this frame
+            if not camera.mask_propagator.needs_detection(gray):
+                camera.keyframe_selector.mark_keyframe(context['start_time'])
+                self.finish_frame(context, camera.mask_propagator.propagate(gray))
+                return
+
+            # The segmented frame becomes the new tracking reference once its result is back
+            context['gray'] = gray
+            context['detection_token'] = camera.mask_propagator.detection_submitted()
+
+        context['previous_keyframe'] = camera.keyframe_selector.mark_keyframe(context['start_time'])
+
+        # The dropped frame is this one under 'drop_newest', or the oldest queued frame of any camera under 'drop_oldest'
+        dropped_context = self.inference_pool.submit(rgb_image, context)
+        if dropped_context is not None:
+            self.logger.debug("Inference queue full, dropped a frame.")
+            self.undo_frame_submission(dropped_context)
+            self.frame_scheduler.frame_dropped()
+
+    def undo_frame_submission(self, context):
+        """Undo the keyframe and cascade bookkeeping of a frame that was never segmented, so its camera is not held back."""
+        camera = context['camera']
+        camera.keyframe_selector.restore_keyframe(context['previous_keyframe'], context['start_time'])
+        if 'detection_token' in context:
+            camera.mask_propagator.detection_dropped(context['detection_token'])
+
+    def inference_result_callback(self):
+        """Timer callback to back-project and publish frames the inference pool has finished."""
+        for context, instances, error in self.inference_pool.get_results():
+            if error is not None:
+                self.logger.error(f"Inference failed: {error}")
+                self.undo_frame_submission(context)
+                self.frame_scheduler.frame_dropped()
+                continue
 
-        # Convert ROS depth image message to OpenCV format
-        self.depth_image = self.bridge.imgmsg_to_cv2(msg, desired_encoding='passthrough')
+            mask_propagator = context['camera'].mask_propagator
+            if mask_propagator is not None:
+                mask_propagator.set_reference(context['gray'], instances)
 
-    def camera_info_callback(self, msg):
-        """Callback to process incoming camera intrinsic parameters."""
+            self.finish_frame(context, instances)
+
+        if not self.trigger and self.frame_scheduler.in_flight == 0:
+            self.inference_result_timer.cancel()
+
+    def finish_frame(self, context, instances):
+        """Back-project the instances of a frame and publish them as a labeled point cloud in the frame of its camera."""
+        camera = context['camera']
+
+        # Convert the depth message to metres and gate it to the valid range, only now that it is actually needed
+        try:
+            depth_image = depth_msg_to_metres(context['depth_msg'], self.MIN_DEPTH, self.MAX_DEPTH)
+        except ValueError as error:
+            self.logger.error(f"Failed to ingest depth image: {error}")
+            self.frame_scheduler.frame_dropped()
+            return
+
+        # Map the masks from the model's letterboxed resolution into depth image coordinates
+        instances = align_instances_to_depth(instances, depth_image.shape)
+
+        # Compute 3D positions and per-object summaries for detected objects
+        # The rays come from the RGB camera info, so they are rescaled when the depth image has another resolution
+        ray_table = camera.ray_table_for(depth_image.shape)
+        if ray_table is not camera.ray_table:
+            self.logger.debug(f"Depth image of camera '{camera.namespace}' is {depth_image.shape[1]}x{depth_image.shape[0]}, "
+                              f"using rays rescaled from {camera.ray_table.width}x{camera.ray_table.height}.")
+        labeled_points_3d, summaries = self.find_3d_positions(instances, depth_image, ray_table)
+
+        # Publish the compact summaries, and the dense 3D points only if they are wanted
+        self.publish_summary(summaries, context['stamp'], camera.frame_id)
+        if self.PUBLISH_DENSE_CLOUD:
+            self.publish_pointcloud(labeled_points_3d, context['stamp'], camera.frame_id)
+
+        self.frame_scheduler.frame_finished(context['start_time'])
+
+    def metrics_timer_callback(self):
+        """Timer callback to publish the frame scheduler metrics."""
+        metrics = self.frame_scheduler.get_metrics()
+        metrics['pool_dropped_frames'] = self.inference_pool.dropped_frames
+        metrics['keyframe_skipped_frames'] = sum(camera.keyframe_selector.skipped_frames for camera in self.cameras)
+        if self.CASCADE_MODE:
+            metrics['detected_frames'] = sum(camera.mask_propagator.detected_frames for camera in self.cameras)
+            metrics['tracked_frames'] = sum(camera.mask_propagator.tracked_frames for camera in self.cameras)
+
+        # Inference statistics of the segmenter replicas since the last metrics
+        segmenter_stats = self.inference_pool.pop_segmenter_stats()
+        segmented_frames = segmenter_stats.get('frames', 0)
+        if segmented_frames > 0:
+            if self.TWO_TIER_MODE:
+                escalated_frames = segmenter_stats.get('escalated_frames', 0)
+                metrics['escalation_rate'] = escalated_frames / segmented_frames
+                metrics['primary_latency'] = segmenter_stats.get('primary_time', 0.0) / segmented_frames
+                metrics['escalation_latency'] = segmenter_stats.get('escalation_time', 0.0) / escalated_frames if escalated_frames else None
+                self.logger.info(f"Two-tier segmentation: escalated {escalated_frames}/{segmented_frames} frames "
+                                 f"({metrics['escalation_rate']:.0%}), primary latency {metrics['primary_latency'] * 1000:.1f} ms, "
+                                 f"escalation latency {(metrics['escalation_latency'] or 0.0) * 1000:.1f} ms")
+            else:
+                metrics['inference_latency'] = segmenter_stats.get('inference_time', 0.0) / segmented_frames
+
+        self.metrics_pub.publish(String(data=json.dumps(metrics)))
+        self.logger.debug(f"Frame scheduler metrics: {metrics}")
+
+    def camera_info_callback(self, camera, msg):
+        """Callback to process incoming camera intrinsic parameters of a camera."""
         # Extract the camera intrinsic matrix from the CameraInfo message
-        self.camera_matrix = np.array(msg.k).reshape((3, 3))
-        self.camera_info_received = True  # Mark that camera info is received
+        camera_matrix = np.array(msg.k).reshape((3, 3))
+
+        # Only rebuild the ray lookup table when K or the resolution actually changed
+        if camera.ray_table is None or not camera.ray_table.matches(camera_matrix, msg.width, msg.height):
+            camera.camera_matrix = camera_matrix
+            camera.ray_table = RayLookupTable(camera_matrix, msg.width, msg.height)
+            camera.depth_ray_table = None
+            self.logger.debug(f"Ray lookup table built for {msg.width}x{msg.height} camera '{camera.namespace}'.")
+
+        camera.camera_info_received = True  # Mark that camera info is received
         self.logger.debug('Camera info received!')
 
-    def segment_image(self, image):
-        """Perform YOLO-based segmentation on the RGB image."""
-        results = self.model.predict(image, device=self.device, task='segment')
-        labeled_masks = {}
+    def find_3d_positions(self, instances, depth_image, ray_table):
+        """Compute 3D positions of objects using depth data, decimated per object before publishing, and one summary per object."""
+        object_points = []
+        summaries = []
+
+        for instance in instances:
+            label = instance['label']
 
-        for result in results:
-            if result.masks is None:  # Skip if no masks are found
+            # Only the pixels inside the instance's bounding box are touched
+            points = back_project_instances([instance], [self.label_mapping[label]], depth_image, ray_table)
+            if points.shape[0] == 0:
                 continue
 
-            # Process detected masks and bounding boxes
-            for mask, box in zip(result.masks.data, result.boxes):
-                confidence = float(box.conf[0])
-                label_index = int(box.cls[0])
-                label = self.model.names[label_index]
-
-                # Include only objects with high confidence and relevant labels
-                if confidence > self.CONFIDENCE and label in self.label_mapping:
-                    mask_resized = mask.cpu().numpy().astype(np.uint8)
-                    labeled_masks[label] = mask_resized
-
-        return image, labeled_masks
-
-    def find_3d_positions(self, labeled_masks, depth_image):
-        """Compute 3D positions of objects using depth data."""
-        labeled_points_3d = []
-        fx, fy = self.camera_matrix[0, 0], self.camera_matrix[1, 1]
-        cx, cy = self.camera_matrix[0, 2], self.camera_matrix[1, 2]
-
-        for label, mask in labeled_masks.items():
-            label_id = self.label_mapping[label]
-            height, width = mask.shape
-            for v in range(height):
-                for u in range(width):
-                    if mask[v, u]:
-                        depth_value = depth_image[v, u]
-                        if depth_value == 0:  # Skip invalid depth values
-                            continue
-                        z = depth_value
-                        x = (u - cx) * z / fx
-                        y = (v - cy) * z / fy
-                        labeled_points_3d.append((x, y, z, label_id))
-
-        valid_points = []
-        
-        for point in labeled_points_3d:
-            
-            x, y, z, label = point
-            
-            # Check if any of the x, y, z values are NaN or Inf
-            if math.isnan(x) or math.isinf(x) or math.isnan(y) or math.isinf(y) or math.isnan(z) or math.isinf(z):
-                continue  # Skip this point if it's invalid
-            
-            # If valid, add the point to the result list
-            valid_points.append(point)
-
-        return valid_points
-
-    def publish_pointcloud(self, labeled_points_3d, timestamp):
+            # The summary is taken over all points of the object, before decimation
+            summaries.append(summarize_object(points, instance['confidence']))
+            if not self.PUBLISH_DENSE_CLOUD:
+                continue
+
+            # Downsample on a voxel grid sized for the label, then cap the number of points of the object
+            points = voxel_downsample(points, self.VOXEL_SIZE_PER_LABEL.get(label, self.VOXEL_SIZE))
+            points = cap_points(points, self.MAX_POINTS_PER_OBJECT, self.rng)
+
+            object_points.append(points)
+
+        if not object_points:
+            return np.empty((0, 4), dtype=np.float32), summaries
+
+        return np.concatenate(object_points), summaries
+
+    def publish_pointcloud(self, labeled_points_3d, timestamp, frame_id):
         """Publish detected 3D points as a PointCloud2 message."""
         pointcloud_msg = PointCloud2()
         pointcloud_msg.header.stamp = timestamp
-        pointcloud_msg.header.frame_id = 'head_front_camera_rgb_optical_frame'
+        pointcloud_msg.header.frame_id = frame_id
 
         fields = [
             PointField(name='x', offset=0, datatype=PointField.FLOAT32, count=1),
@@ -231,8 +539,8 @@ class ImageSegmentationNode(Node):
         ]
         pointcloud_msg.fields = fields
 
-        pointcloud_data = [struct.pack('fffI', x, y, z, label_id) for x, y, z, label_id in labeled_points_3d]
-        pointcloud_msg.data = b''.join(pointcloud_data)
+        # Encode all points into a single buffer in one go
+        pointcloud_msg.data = encode_labeled_points(labeled_points_3d)
         pointcloud_msg.is_bigendian = False
         pointcloud_msg.point_step = 16
         pointcloud_msg.row_step = pointcloud_msg.point_step * len(labeled_points_3d)
@@ -243,6 +551,39 @@ class ImageSegmentationNode(Node):
         self.pointcloud_pub.publish(pointcloud_msg)
         #self.logger.debug(f"Published PointCloud2 with {len(labeled_points_3d)} points")
 
+    def publish_summary(self, summaries, timestamp, frame_id):
+        """Publish one point per detected object, carrying its extent, confidence, label and point count, as a PointCloud2 message."""
+        summary_msg = PointCloud2()
+        summary_msg.header.stamp = timestamp
+        summary_msg.header.frame_id = frame_id
+
+        summary_msg.fields = [
+            PointField(name='x', offset=0, datatype=PointField.FLOAT32, count=1),
+            PointField(name='y', offset=4, datatype=PointField.FLOAT32, count=1),
+            PointField(name='z', offset=8, datatype=PointField.FLOAT32, count=1),
+            PointField(name='size_x', offset=12, datatype=PointField.FLOAT32, count=1),
+            PointField(name='size_y', offset=16, datatype=PointField.FLOAT32, count=1),
+            PointField(name='size_z', offset=20, datatype=PointField.FLOAT32, count=1),
+            PointField(name='confidence', offset=24, datatype=PointField.FLOAT32, count=1),
+            PointField(name='label', offset=28, datatype=PointField.UINT32, count=1),
+            PointField(name='point_count', offset=32, datatype=PointField.UINT32, count=1),
+        ]
+
+        summary_msg.data = encode_object_summaries(summaries)
+        summary_msg.is_bigendian = False
+        summary_msg.point_step = 36
+        summary_msg.row_step = summary_msg.point_step * len(summaries)
+        summary_msg.is_dense = True
+        summary_msg.width = len(summaries)
+        summary_msg.height = 1
+
+        self.summary_pub.publish(summary_msg)
+
+    def destroy_node(self):
+        """Stop the inference workers before destroying the node."""
+        self.inference_pool.shutdown()
+        Node.destroy_node(self)
+
 
 
 
@@ -256,7 +597,43 @@ def main():
     # Get settings from 'settings.json' file
     NODE_LOG_LEVEL = "rclpy.logging.LoggingSeverity." + json_handler.get_subkey_value("ImageSegmentationNode", "NODE_LOG_LEVEL")
     CONFIDENCE = json_handler.get_subkey_value("ImageSegmentationNode", "CONFIDENCE")
-    FRAME_SKIPPED = json_handler.get_subkey_value("ImageSegmentationNode", "FRAME_SKIPPED")
+    SYNC_TOLERANCE = json_handler.get_subkey_value("ImageSegmentationNode", "SYNC_TOLERANCE")
+    DEPTH_BUFFER_SIZE = json_handler.get_subkey_value("ImageSegmentationNode", "DEPTH_BUFFER_SIZE")
+    INFERENCE_POOL_TYPE = json_handler.get_subkey_value("ImageSegmentationNode", "INFERENCE_POOL_TYPE")
+    INFERENCE_WORKERS = json_handler.get_subkey_value("ImageSegmentationNode", "INFERENCE_WORKERS")
+    INFERENCE_QUEUE_SIZE = json_handler.get_subkey_value("ImageSegmentationNode", "INFERENCE_QUEUE_SIZE")
+    DROP_POLICY = json_handler.get_subkey_value("ImageSegmentationNode", "DROP_POLICY")
+    BATCH_MODE = json_handler.get_subkey_value("ImageSegmentationNode", "BATCH_MODE")
+    MAX_BATCH_SIZE = json_handler.get_subkey_value("ImageSegmentationNode", "MAX_BATCH_SIZE")
+    MAX_BATCH_WAIT = json_handler.get_subkey_value("ImageSegmentationNode", "MAX_BATCH_WAIT")
+    MODEL_PATH = json_handler.get_subkey_value("ImageSegmentationNode", "MODEL_PATH")
+    INFERENCE_BACKEND = json_handler.get_subkey_value("ImageSegmentationNode", "INFERENCE_BACKEND")
+    MODEL_CACHE_DIR = json_handler.get_subkey_value("ImageSegmentationNode", "MODEL_CACHE_DIR")
+    TARGET_RATE = json_handler.get_subkey_value("ImageSegmentationNode", "TARGET_RATE")
+    CPU_BUDGET = json_handler.get_subkey_value("ImageSegmentationNode", "CPU_BUDGET")
+    COST_SMOOTHING = json_handler.get_subkey_value("ImageSegmentationNode", "COST_SMOOTHING")
+    METRICS_PERIOD = json_handler.get_subkey_value("ImageSegmentationNode", "METRICS_PERIOD")
+    IMGSZ = json_handler.get_subkey_value("ImageSegmentationNode", "IMGSZ")
+    VOXEL_SIZE = json_handler.get_subkey_value("ImageSegmentationNode", "VOXEL_SIZE")
+    VOXEL_SIZE_PER_LABEL = json_handler.get_subkey_value("ImageSegmentationNode", "VOXEL_SIZE_PER_LABEL")
+    MAX_POINTS_PER_OBJECT = json_handler.get_subkey_value("ImageSegmentationNode", "MAX_POINTS_PER_OBJECT")
+    # The launch files give RTAB-Map the same depth range as constants, keep them in step
+    MIN_DEPTH = json_handler.get_subkey_value("ImageSegmentationNode", "MIN_DEPTH")
+    MAX_DEPTH = json_handler.get_subkey_value("ImageSegmentationNode", "MAX_DEPTH")
+    KEYFRAME_TRANSLATION = json_handler.get_subkey_value("ImageSegmentationNode", "KEYFRAME_TRANSLATION")
+    KEYFRAME_ROTATION = json_handler.get_subkey_value("ImageSegmentationNode", "KEYFRAME_ROTATION")
+    KEYFRAME_REFRESH_PERIOD = json_handler.get_subkey_value("ImageSegmentationNode", "KEYFRAME_REFRESH_PERIOD")
+    CASCADE_MODE = json_handler.get_subkey_value("ImageSegmentationNode", "CASCADE_MODE")
+    CASCADE_INTERVAL = json_handler.get_subkey_value("ImageSegmentationNode", "CASCADE_INTERVAL")
+    CASCADE_CHANGE_THRESHOLD = json_handler.get_subkey_value("ImageSegmentationNode", "CASCADE_CHANGE_THRESHOLD")
+    TWO_TIER_MODE = json_handler.get_subkey_value("ImageSegmentationNode", "TWO_TIER_MODE")
+    PRIMARY_MODEL_PATH = json_handler.get_subkey_value("ImageSegmentationNode", "PRIMARY_MODEL_PATH")
+    ESCALATION_BAND = json_handler.get_subkey_value("ImageSegmentationNode", "ESCALATION_BAND")
+    QUANTIZATION = json_handler.get_subkey_value("ImageSegmentationNode", "QUANTIZATION")
+    CALIBRATION_DIR = json_handler.get_subkey_value("ImageSegmentationNode", "CALIBRATION_DIR")
+    WARMUP_TIMEOUT = json_handler.get_subkey_value("ImageSegmentationNode", "WARMUP_TIMEOUT")
+    PUBLISH_DENSE_CLOUD = json_handler.get_subkey_value("ImageSegmentationNode", "PUBLISH_DENSE_CLOUD")
+    CAMERAS = json_handler.get_subkey_value("ImageSegmentationNode", "CAMERAS")
     
     # Initialize the rclpy library.
     rclpy.init()
@@ -274,10 +651,28 @@ def main():
     rclpy.logging.set_logger_level("image_segmentation_node", eval(NODE_LOG_LEVEL))
     
     # Instance the Main class
-    image_segmentation_node = ImageSegmentationNode(CONFIDENCE, FRAME_SKIPPED)
+    image_segmentation_node = ImageSegmentationNode(CONFIDENCE, SYNC_TOLERANCE, DEPTH_BUFFER_SIZE,
+                                                    INFERENCE_POOL_TYPE, INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE, DROP_POLICY,
+                                                    BATCH_MODE, MAX_BATCH_SIZE, MAX_BATCH_WAIT,
+                                                    MODEL_PATH, INFERENCE_BACKEND, MODEL_CACHE_DIR,
+                                                    TARGET_RATE, CPU_BUDGET, COST_SMOOTHING, METRICS_PERIOD,
+                                                    IMGSZ, VOXEL_SIZE, VOXEL_SIZE_PER_LABEL, MAX_POINTS_PER_OBJECT,
+                                                    MIN_DEPTH, MAX_DEPTH,
+                                                    KEYFRAME_TRANSLATION, KEYFRAME_ROTATION, KEYFRAME_REFRESH_PERIOD,
+                                                    CASCADE_MODE, CASCADE_INTERVAL, CASCADE_CHANGE_THRESHOLD,
+                                                    TWO_TIER_MODE, PRIMARY_MODEL_PATH, ESCALATION_BAND,
+                                                    QUANTIZATION, CALIBRATION_DIR, WARMUP_TIMEOUT,
+                                                    PUBLISH_DENSE_CLOUD, CAMERAS)
     
     # Begin looping the node
-    rclpy.spin(image_segmentation_node)
+    try:
+        rclpy.spin(image_segmentation_node)
+    except KeyboardInterrupt:
+        image_segmentation_node.logger.info("Shutting down ImageSegmentationNode.")
+
+    finally:
+        image_segmentation_node.destroy_node()
+        rclpy.shutdown()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,6 +1,17 @@
+import array
+import collections
+import concurrent.futures
 import json
 import logging
+import math
+import multiprocessing
 import os
+import queue
+import shutil
+import threading
+import time
+
+import numpy as np
 
 
 
@@ -82,3 +93,1683 @@ class JSON_Handler:
         else:
             return False  # Input is not a JSON object
 
+
+
+# Memory layout of a labeled point in our PointCloud2 messages (x, y, z as float32 and label as uint32)
+LABELED_POINT_DTYPE = np.dtype([
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('z', '<f4'),
+    ('label', '<u4'),
+])
+
+# Layout of one object in a summary PointCloud2 message: robust centroid, extent, confidence, label id and point count
+OBJECT_SUMMARY_DTYPE = np.dtype([
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('z', '<f4'),
+    ('size_x', '<f4'),
+    ('size_y', '<f4'),
+    ('size_z', '<f4'),
+    ('confidence', '<f4'),
+    ('label', '<u4'),
+    ('point_count', '<u4'),
+])
+
+
+class RayLookupTable:
+    """
+    Class for caching the per-pixel unit rays (x/z, y/z) of a pinhole camera, so back-projection becomes a single multiply by depth.
+    """
+
+    def __init__(self, camera_matrix, width, height):
+
+        self.camera_matrix = np.array(camera_matrix, dtype=np.float64).reshape((3, 3))
+        self.width = int(width)
+        self.height = int(height)
+
+        fx, fy = self.camera_matrix[0, 0], self.camera_matrix[1, 1]
+        cx, cy = self.camera_matrix[0, 2], self.camera_matrix[1, 2]
+
+        # Per-pixel ray grids with shape (height, width)
+        u, v = np.meshgrid(np.arange(self.width), np.arange(self.height))
+        self.ray_x = ((u - cx) / fx).astype(np.float32)
+        self.ray_y = ((v - cy) / fy).astype(np.float32)
+
+
+    def matches(self, camera_matrix, width, height):
+        """
+        Function for checking whether the table was built for the given intrinsics and resolution.
+        """
+        return (self.width == int(width) and self.height == int(height)
+                and np.array_equal(self.camera_matrix, np.asarray(camera_matrix, dtype=np.float64).reshape((3, 3))))
+
+
+    def for_resolution(self, width, height):
+        """
+        Function for getting the table of the same camera at another resolution, e.g. a depth image which is not the
+        size of the RGB image the camera info describes. The intrinsics are scaled about the pixel centres.
+
+        Returns:
+            RayLookupTable: This table if the resolution already matches, otherwise a new table.
+        """
+        if self.width == int(width) and self.height == int(height):
+            return self
+
+        scale_x = int(width) / self.width
+        scale_y = int(height) / self.height
+        camera_matrix = self.camera_matrix.copy()
+        camera_matrix[0, 0] *= scale_x
+        camera_matrix[1, 1] *= scale_y
+        camera_matrix[0, 2] = (camera_matrix[0, 2] + 0.5) * scale_x - 0.5
+        camera_matrix[1, 2] = (camera_matrix[1, 2] + 0.5) * scale_y - 0.5
+        return RayLookupTable(camera_matrix, width, height)
+
+
+def letterbox_transform(mask_shape, image_shape):
+    """
+    Function for getting the transform from input image pixels to the model's letterboxed mask pixels.
+
+    Args:
+        mask_shape (tuple): Shape (height, width) of the letterboxed model mask.
+        image_shape (tuple): Shape (height, width) of the input image.
+
+    Returns:
+        tuple: Scale 'gain' and offsets 'pad_x', 'pad_y', so that mask_u = image_u * gain + pad_x.
+    """
+    gain = min(mask_shape[0] / image_shape[0], mask_shape[1] / image_shape[1])
+    pad_x = (mask_shape[1] - image_shape[1] * gain) / 2
+    pad_y = (mask_shape[0] - image_shape[0] * gain) / 2
+    return gain, pad_x, pad_y
+
+
+def align_instances_to_depth(instances, depth_shape):
+    """
+    Function for mapping instance masks from the model's letterboxed resolution into depth image coordinates.
+
+    Each depth pixel inside the instance's bounding box is mapped through the depth-to-image scale and the letterbox
+    transform, and takes the value of the model mask pixel it lands in (nearest neighbour). The sampling is separable,
+    so every mask is aligned with one fancy-indexing operation.
+
+    Returns:
+        list: Copies of the instances, with 'bbox' and 'mask' in depth image pixels, as 'back_project_instances' expects.
+    """
+    depth_height, depth_width = depth_shape[:2]
+    aligned_instances = []
+
+    for instance in instances:
+        image_height, image_width = instance['image_shape']
+        gain, pad_x, pad_y = letterbox_transform(instance['mask_shape'], instance['image_shape'])
+        scale_x = image_width / depth_width
+        scale_y = image_height / depth_height
+
+        # Bounding box in depth image pixels
+        x_min, y_min, x_max, y_max = instance['bbox']
+        bbox = (max(0, int(x_min / scale_x)), max(0, int(y_min / scale_y)),
+                min(depth_width, int(math.ceil(x_max / scale_x))), min(depth_height, int(math.ceil(y_max / scale_y))))
+        if bbox[2] <= bbox[0] or bbox[3] <= bbox[1]:
+            continue
+
+        # Model mask pixel hit by the centre of every depth pixel column and row, relative to the cropped mask
+        mask_x_min, mask_y_min, _, _ = instance['mask_bbox']
+        cols = np.floor((np.arange(bbox[0], bbox[2]) + 0.5) * scale_x * gain + pad_x).astype(np.intp) - mask_x_min
+        rows = np.floor((np.arange(bbox[1], bbox[3]) + 0.5) * scale_y * gain + pad_y).astype(np.intp) - mask_y_min
+
+        mask_cropped = instance['mask']
+        valid_cols = (cols >= 0) & (cols < mask_cropped.shape[1])
+        valid_rows = (rows >= 0) & (rows < mask_cropped.shape[0])
+
+        mask = np.zeros((rows.shape[0], cols.shape[0]), dtype=bool)
+        mask[np.ix_(valid_rows, valid_cols)] = mask_cropped[np.ix_(rows[valid_rows], cols[valid_cols])]
+
+        aligned_instance = dict(instance)
+        aligned_instance['bbox'] = bbox
+        aligned_instance['mask'] = mask
+        aligned_instances.append(aligned_instance)
+
+    return aligned_instances
+
+def back_project_instances(instances, label_ids, depth_image, ray_table):
+    """
+    Function for back-projecting segmented instances into 3D camera-frame points, touching only the pixels inside
+    each instance's bounding box.
+
+    Args:
+        instances (list): Instances with a 'bbox' (x_min, y_min, x_max, y_max) and a 'mask' cropped to it.
+        label_ids (sequence): Label id of each instance.
+        depth_image (np.ndarray): Depth image with shape (H, W), in metres.
+        ray_table (RayLookupTable): Cached unit rays of the camera the depth image belongs to, at the depth resolution.
+
+    Returns:
+        np.ndarray: Array with shape (N, 4) holding x, y, z and label id of every valid point.
+
+    Raises:
+        ValueError: If the ray table was built for another resolution than the depth image.
+    """
+    depth_image = np.asarray(depth_image, dtype=np.float32)
+    if depth_image.shape[:2] != (ray_table.height, ray_table.width):
+        raise ValueError(f"Ray table is {ray_table.width}x{ray_table.height}, "
+                         f"depth image is {depth_image.shape[1]}x{depth_image.shape[0]}")
+    instance_points = []
+
+    for instance, label_id in zip(instances, label_ids):
+        x_min, y_min, x_max, y_max = instance['bbox']
+
+        # Pixel coordinates of the masked pixels, relative to the full image
+        v, u = np.nonzero(instance['mask'])
+        v += y_min
+        u += x_min
+        z = depth_image[v, u]
+
+        # Skip invalid (zero) and non-finite depth values before doing any arithmetic
+        valid = (z != 0) & np.isfinite(z)
+        v, u, z = v[valid], u[valid], z[valid]
+
+        points = np.empty((z.shape[0], 4), dtype=np.float32)
+        points[:, 0] = ray_table.ray_x[v, u] * z
+        points[:, 1] = ray_table.ray_y[v, u] * z
+        points[:, 2] = z
+        points[:, 3] = label_id
+        instance_points.append(points)
+
+    if not instance_points:
+        return np.empty((0, 4), dtype=np.float32)
+
+    points = np.concatenate(instance_points)
+
+    # Drop any point where x or y became NaN or Inf
+    return points[np.isfinite(points[:, :3]).all(axis=1)]
+
+
+def voxel_downsample(points, voxel_size):
+    """
+    Function for downsampling points on a voxel grid, replacing all points falling into the same voxel by their centroid.
+
+    Args:
+        points (np.ndarray): Array with shape (N, 4) holding x, y, z and label id.
+        voxel_size (float): Edge length of the voxels in metres. A size of 0 or less disables the downsampling.
+
+    Returns:
+        np.ndarray: Array with shape (M, 4), M <= N, keeping the label of the first point in each voxel.
+    """
+    if voxel_size <= 0 or points.shape[0] == 0:
+        return points
+
+    # Integer voxel coordinates, packed into a single key per point so a 1D unique can be used
+    voxels = np.floor(points[:, :3] / voxel_size).astype(np.int64)
+    voxels -= voxels.min(axis=0)
+    dims = voxels.max(axis=0) + 1
+    keys = (voxels[:, 0] * dims[1] + voxels[:, 1]) * dims[2] + voxels[:, 2]
+
+    _, first_index, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+
+    downsampled = np.empty((counts.shape[0], 4), dtype=np.float32)
+    for axis in range(3):
+        downsampled[:, axis] = np.bincount(inverse, weights=points[:, axis], minlength=counts.shape[0]) / counts
+    downsampled[:, 3] = points[first_index, 3]
+
+    return downsampled
+
+
+class VoxelHashIndex:
+    """
+    Class for a spatial hash over the points of a 'LabeledPointStore', used to keep only points at least
+    'distance_threshold' apart.
+
+    The cells are as wide as the distance threshold, so every point closer than the threshold to a query point lies in
+    one of the 27 cells around the query point's cell. A proximity check therefore costs the same however many points
+    are indexed.
+
+    The index holds no coordinates of its own, it reads them from the rows of the store. Each cell (i, j, k) is packed
+    into one int64 key, and the rows are kept sorted by key, so the rows of a cell are found by binary search. The
+    index costs 12 bytes per point on top of the 16 bytes of the store. Points must be added through 'insert' or
+    'insert_if_far', so the store and the index stay in step.
+    """
+
+    # Cells are packed with 21 bits per axis, covering +-2**20 cells (+-31 km at a 3 cm threshold) around the origin
+    CELL_BITS = 21
+    CELL_OFFSET = 1 << (CELL_BITS - 1)
+
+    # Key offsets of the 9 (i, j) columns around a cell. Along k the 3 neighbouring keys are consecutive, so each
+    # column is a single key range.
+    NEIGHBOUR_KEY_OFFSETS = (np.array([(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)], dtype=np.int64)
+                             @ np.array([1 << (2 * CELL_BITS), 1 << CELL_BITS], dtype=np.int64))
+
+    def __init__(self, distance_threshold, store):
+
+        self.DISTANCE_THRESHOLD = distance_threshold
+
+        self.store = store
+        self.sorted_keys = np.empty(0, dtype=np.int64)  # Cell key of every indexed row, ascending
+        self.sorted_rows = np.empty(0, dtype=np.int32)  # Store row belonging to each entry of 'sorted_keys'
+
+
+    def __len__(self):
+        return self.sorted_keys.shape[0]
+
+
+    def clear(self):
+        """
+        Function for removing all points from the index and its store.
+        """
+        self.store.clear()
+        self.sorted_keys = np.empty(0, dtype=np.int64)
+        self.sorted_rows = np.empty(0, dtype=np.int32)
+
+
+    def keys_of(self, points):
+        """
+        Function for getting the packed int64 cell keys of an (N, 3) array of points.
+        """
+        cells = np.floor(np.asarray(points, dtype=np.float64) / self.DISTANCE_THRESHOLD).astype(np.int64) + self.CELL_OFFSET
+        return (cells[:, 0] << (2 * self.CELL_BITS)) + (cells[:, 1] << self.CELL_BITS) + cells[:, 2]
+
+
+    def neighbour_pairs(self, keys, sorted_keys, sorted_rows):
+        """
+        Function for pairing every query key with the rows in the 27 cells around it.
+
+        Args:
+            keys (np.ndarray): (N,) cell keys of the query points.
+            sorted_keys (np.ndarray): (M,) ascending cell keys of the candidate rows.
+            sorted_rows (np.ndarray): (M,) candidate row belonging to each key.
+
+        Returns:
+            tuple: (query indices, candidate rows), one entry per pair, grouped by ascending query index.
+        """
+        # The 9 key ranges around every distinct cell of the query
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        column_keys = (unique_keys[:, None] + self.NEIGHBOUR_KEY_OFFSETS).ravel()
+        range_starts = np.searchsorted(sorted_keys, column_keys - 1, side='left')
+        range_counts = np.searchsorted(sorted_keys, column_keys + 1, side='right') - range_starts
+
+        # Candidate rows of all ranges, grouped by distinct cell
+        num_candidates = int(range_counts.sum())
+        range_offsets = np.cumsum(range_counts) - range_counts
+        candidate_rows = sorted_rows[np.repeat(range_starts - range_offsets, range_counts) + np.arange(num_candidates)]
+        cell_counts = range_counts.reshape(-1, self.NEIGHBOUR_KEY_OFFSETS.shape[0]).sum(axis=1)
+        cell_starts = np.cumsum(cell_counts) - cell_counts
+
+        # Expand into one (query, candidate row) pair per candidate of the query's cell
+        point_counts = cell_counts[inverse]
+        num_pairs = int(point_counts.sum())
+        pair_points = np.repeat(np.arange(keys.shape[0]), point_counts)
+        pair_offsets = np.arange(num_pairs) - np.repeat(np.cumsum(point_counts) - point_counts, point_counts)
+        pair_rows = candidate_rows[np.repeat(cell_starts[inverse], point_counts) + pair_offsets]
+        return pair_points, pair_rows
+
+
+    def too_close(self, points):
+        """
+        Function for checking a batch of points against the indexed points in bulk.
+
+        The indexed rows around each distinct cell of the batch are looked up once, after which all point-to-candidate
+        distances are computed in one vectorized operation.
+
+        Args:
+            points (np.ndarray): Array with shape (N, 3).
+
+        Returns:
+            np.ndarray: Boolean mask with shape (N,), True where an indexed point is closer than the threshold.
+        """
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        result = np.zeros(points.shape[0], dtype=bool)
+        if len(self) == 0 or points.shape[0] == 0:
+            return result
+
+        pair_points, pair_rows = self.neighbour_pairs(self.keys_of(points), self.sorted_keys, self.sorted_rows)
+        squared_distances = np.square(points[pair_points] - self.store.data[pair_rows, :3]).sum(axis=1)
+        result[pair_points[squared_distances < self.DISTANCE_THRESHOLD ** 2]] = True
+        return result
+
+
+    def insert_if_far(self, points, labels):
+        """
+        Function for storing and indexing the points of a batch which are not closer than the threshold to any indexed
+        point, nor to a point accepted earlier in the same batch.
+
+        Args:
+            points (np.ndarray): Array with shape (N, 3).
+            labels (np.ndarray): Label ids with shape (N,).
+
+        Returns:
+            np.ndarray: Boolean mask with shape (N,), True for the points that were stored.
+        """
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        accepted = ~self.too_close(points)
+
+        # Points surviving the bulk check are only compared against the points of this batch before them
+        candidates = np.flatnonzero(accepted)
+        candidate_points = points[candidates]
+        candidate_keys = self.keys_of(candidate_points)
+        order = np.argsort(candidate_keys, kind='stable')
+        pair_points, pair_rows = self.neighbour_pairs(candidate_keys, candidate_keys[order], order.astype(np.int32))
+
+        earlier = pair_rows < pair_points
+        pair_points, pair_rows = pair_points[earlier], pair_rows[earlier]
+        close = np.square(candidate_points[pair_points] - candidate_points[pair_rows]).sum(axis=1) < self.DISTANCE_THRESHOLD ** 2
+        pair_points, pair_rows = pair_points[close], pair_rows[close]
+
+        # A point with close points before it is kept only if none of them was kept, decided in batch order
+        if pair_points.shape[0] > 0:
+            keep = np.ones(candidates.shape[0], dtype=bool)
+            conflicted, group_starts = np.unique(pair_points, return_index=True)
+            for point, earlier_rows in zip(conflicted.tolist(), np.split(pair_rows, group_starts[1:])):
+                keep[point] = not keep[earlier_rows].any()
+            accepted[candidates[~keep]] = False
+
+        self.insert(points[accepted], np.asarray(labels)[accepted])
+        return accepted
+
+
+    def insert(self, points, labels):
+        """
+        Function for storing and indexing points without any proximity check.
+        """
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        if points.shape[0] == 0:
+            return
+
+        first_row = len(self.store)
+        self.store.append(points, labels)
+
+        # Merge the keys of the new rows into the sorted arrays
+        keys = self.keys_of(points)
+        order = np.argsort(keys, kind='stable')
+        positions = np.searchsorted(self.sorted_keys, keys[order], side='right')
+        self.sorted_keys = np.insert(self.sorted_keys, positions, keys[order])
+        self.sorted_rows = np.insert(self.sorted_rows, positions, (order + first_row).astype(np.int32))
+
+
+def cap_points(points, max_points, rng=None):
+    """
+    Function for randomly subsampling points down to at most 'max_points'. A cap of 0 or less disables it.
+    """
+    if max_points <= 0 or points.shape[0] <= max_points:
+        return points
+
+    rng = np.random.default_rng() if rng is None else rng
+    return points[rng.choice(points.shape[0], max_points, replace=False)]
+
+def encode_labeled_points(points):
+    """
+    Function for encoding an (N, 4) array of x, y, z and label id into the payload of a PointCloud2 message.
+
+    The points are written into a NumPy structured array matching 'LABELED_POINT_DTYPE' and handed over as
+    a single buffer, so no Python object is created per point.
+
+    Returns:
+        array.array: Byte array which can be assigned directly to 'PointCloud2.data'.
+    """
+    points = np.asarray(points)
+    cloud = np.empty(points.shape[0], dtype=LABELED_POINT_DTYPE)
+    if points.shape[0] > 0:
+        cloud['x'] = points[:, 0]
+        cloud['y'] = points[:, 1]
+        cloud['z'] = points[:, 2]
+        cloud['label'] = points[:, 3]
+
+    # Assigning an 'array.array' skips the element-wise type check of the generated message setter
+    data = array.array('B')
+    data.frombytes(cloud.view(np.uint8))
+    return data
+
+
+# NumPy type of each 'sensor_msgs/PointField' datatype constant
+POINT_FIELD_TYPES = {1: 'i1', 2: 'u1', 3: 'i2', 4: 'u2', 5: 'i4', 6: 'u4', 7: 'f4', 8: 'f8'}
+
+
+def read_labeled_points(msg, skip_nans=True):
+    """
+    Function for reading x, y, z and label straight from the buffer of a PointCloud2 message, whatever its field
+    offsets, point step, row padding and byte order are.
+
+    Args:
+        msg: PointCloud2 message with 'x', 'y', 'z' and 'label' fields.
+        skip_nans (bool): Drop points with a NaN or Inf coordinate.
+
+    Returns:
+        tuple: (N, 3) float32 coordinates and (N,) uint32 label ids.
+    """
+    byte_order = '>' if msg.is_bigendian else '<'
+    fields = {field.name: field for field in msg.fields}
+    names = ['x', 'y', 'z', 'label']
+    point_dtype = np.dtype({
+        'names': names,
+        'formats': [byte_order + POINT_FIELD_TYPES[fields[name].datatype] for name in names],
+        'offsets': [fields[name].offset for name in names],
+        'itemsize': msg.point_step,
+    })
+
+    num_points = msg.width * msg.height
+    if num_points == 0:
+        return np.empty((0, 3), dtype=np.float32), np.empty(0, dtype=np.uint32)
+
+    # Rows may be padded beyond width * point_step, so walk the buffer with the row step as outer stride
+    cloud = np.ndarray(shape=(msg.height, msg.width), dtype=point_dtype, buffer=memoryview(msg.data),
+                       strides=(msg.row_step, msg.point_step)).reshape(-1)
+
+    xyz = np.empty((num_points, 3), dtype=np.float32)
+    xyz[:, 0] = cloud['x']
+    xyz[:, 1] = cloud['y']
+    xyz[:, 2] = cloud['z']
+    labels = cloud['label'].astype(np.uint32)
+
+    if skip_nans:
+        finite = np.isfinite(xyz).all(axis=1)
+        if not finite.all():
+            xyz, labels = xyz[finite], labels[finite]
+
+    return xyz, labels
+
+
+class LabeledPointStore:
+    """
+    Class for a growable store of labeled points, 16 bytes per point.
+
+    Each row of the float32 backing array holds x, y, z and the bits of the uint32 label id, which is exactly the
+    'LABELED_POINT_DTYPE' layout of a PointCloud2 payload, so the store is published straight from its memory.
+    The capacity doubles when full, so appending costs amortized O(1) per point.
+    """
+
+    def __init__(self, initial_capacity=1024):
+
+        self.data = np.empty((max(1, initial_capacity), 4), dtype=np.float32)
+        self.size = 0
+
+
+    def __len__(self):
+        return self.size
+
+
+    @property
+    def xyz(self):
+        """
+        (N, 3) float32 view of the stored coordinates.
+        """
+        return self.data[:self.size, :3]
+
+
+    @property
+    def labels(self):
+        """
+        (N,) uint32 view of the stored label ids.
+        """
+        return self.data[:self.size, 3].view(np.uint32)
+
+
+    def clear(self):
+        """
+        Function for removing all points, keeping the allocated memory.
+        """
+        self.size = 0
+
+
+    def append(self, xyz, labels):
+        """
+        Function for appending (N, 3) coordinates and (N,) label ids.
+        """
+        num_points = len(xyz)
+        if num_points == 0:
+            return
+
+        if self.size + num_points > self.data.shape[0]:
+            capacity = max(self.size + num_points, 2 * self.data.shape[0])
+            grown = np.empty((capacity, 4), dtype=np.float32)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+
+        rows = self.data[self.size:self.size + num_points]
+        rows[:, :3] = xyz
+        rows[:, 3].view(np.uint32)[:] = labels
+        self.size += num_points
+
+
+    def to_pointcloud2_data(self, start=0):
+        """
+        Function for getting the points from row 'start' on as the payload of a PointCloud2 message, in one copy.
+
+        Returns:
+            array.array: Byte array which can be assigned directly to 'PointCloud2.data'.
+        """
+        data = array.array('B')
+        data.frombytes(self.data[start:self.size].view(np.uint8))
+        return data
+
+
+def summarize_object(points, confidence, extent_percentile=5.0):
+    """
+    Function for reducing the back-projected points of one object to a single 'OBJECT_SUMMARY_DTYPE' record.
+
+    The centroid is the per-axis median and the extent spans the 'extent_percentile' to 100 - 'extent_percentile'
+    percentiles, so depth pixels bleeding in from the background at the mask border do not drag either of them away.
+
+    Args:
+        points (np.ndarray): (N, 4) array of x, y, z and label id of one object, with N > 0.
+        confidence (float): Detection confidence of the object.
+        extent_percentile (float): Percentile cut off at both ends of each axis for the extent.
+
+    Returns:
+        np.ndarray: Structured scalar of 'OBJECT_SUMMARY_DTYPE'.
+    """
+    xyz = points[:, :3]
+    lower, median, upper = np.percentile(xyz, [extent_percentile, 50.0, 100.0 - extent_percentile], axis=0)
+
+    summary = np.zeros((), dtype=OBJECT_SUMMARY_DTYPE)
+    summary['x'], summary['y'], summary['z'] = median
+    summary['size_x'], summary['size_y'], summary['size_z'] = upper - lower
+    summary['confidence'] = confidence
+    summary['label'] = points[0, 3]
+    summary['point_count'] = points.shape[0]
+    return summary
+
+
+def encode_object_summaries(summaries):
+    """
+    Function for encoding a list of 'OBJECT_SUMMARY_DTYPE' records into the payload of a PointCloud2 message.
+
+    Returns:
+        array.array: Byte array which can be assigned directly to 'PointCloud2.data'.
+    """
+    records = np.array(summaries, dtype=OBJECT_SUMMARY_DTYPE).reshape(-1)
+
+    data = array.array('B')
+    data.frombytes(records.view(np.uint8))
+    return data
+
+
+def stamp_to_nanoseconds(stamp):
+    """
+    Function for converting a 'builtin_interfaces/Time' stamp into integer nanoseconds.
+    """
+    return stamp.sec * 1000000000 + stamp.nanosec
+
+
+def transform_to_matrix(transform):
+    """
+    Function for converting a 'geometry_msgs/TransformStamped' into a rotation matrix and a translation vector,
+    so a whole point cloud can be transformed with a single matrix multiplication.
+
+    Args:
+        transform: Transform as returned by 'tf2_ros.Buffer.lookup_transform'.
+
+    Returns:
+        tuple: (3, 3) rotation matrix and (3,) translation, both float64.
+
+    Raises:
+        ValueError: If the transform holds NaN or Inf values, or a zero quaternion.
+    """
+    translation = transform.transform.translation
+    rotation = transform.transform.rotation
+    t = np.array([translation.x, translation.y, translation.z], dtype=np.float64)
+    q = np.array([rotation.x, rotation.y, rotation.z, rotation.w], dtype=np.float64)
+
+    if not np.isfinite(t).all():
+        raise ValueError(f"Transform contains invalid translation values: {translation}")
+    if not np.isfinite(q).all():
+        raise ValueError(f"Transform contains invalid rotation values: {rotation}")
+
+    norm = np.linalg.norm(q)
+    if norm == 0.0:
+        raise ValueError(f"Transform contains a zero rotation quaternion: {rotation}")
+    x, y, z, w = q / norm
+
+    rotation_matrix = np.array([
+        [1.0 - 2.0 * (y * y + z * z), 2.0 * (x * y - z * w), 2.0 * (x * z + y * w)],
+        [2.0 * (x * y + z * w), 1.0 - 2.0 * (x * x + z * z), 2.0 * (y * z - x * w)],
+        [2.0 * (x * z - y * w), 2.0 * (y * z + x * w), 1.0 - 2.0 * (x * x + y * y)],
+    ])
+    return rotation_matrix, t
+
+
+def transform_points(points, rotation_matrix, translation):
+    """
+    Function for applying a rotation matrix and translation from 'transform_to_matrix' to an (N, 3) array of points.
+    """
+    return (np.asarray(points, dtype=np.float64) @ rotation_matrix.T + translation).astype(np.float32)
+
+
+
+# Data type and scale to metres of the depth image encodings we can ingest
+DEPTH_ENCODINGS = {
+    '32FC1': (np.float32, 1.0),  # Metres
+    '16UC1': (np.uint16, 0.001),  # Millimetres
+    'mono16': (np.uint16, 0.001),  # Millimetres
+}
+
+
+def depth_msg_to_metres(msg, min_depth, max_depth):
+    """
+    Function for converting a depth 'sensor_msgs/Image' into a float32 image in metres, gated to a valid range.
+
+    The message buffer is viewed directly as an array of its encoding and scaled in one vectorized operation.
+    Depth values outside [min_depth, max_depth] are set to 0, which back-projection treats as invalid.
+
+    Returns:
+        np.ndarray: Depth image with shape (height, width), in metres.
+    """
+    if msg.encoding not in DEPTH_ENCODINGS:
+        raise ValueError(f"Unsupported depth encoding '{msg.encoding}', expected one of {list(DEPTH_ENCODINGS)}")
+
+    dtype, scale = DEPTH_ENCODINGS[msg.encoding]
+    dtype = np.dtype(dtype).newbyteorder('>' if msg.is_bigendian else '<')
+
+    # Rows may be padded, so view the buffer by its step and crop to the image width
+    depth_raw = np.frombuffer(msg.data, dtype=dtype).reshape((msg.height, msg.step // dtype.itemsize))[:, :msg.width]
+    depth_image = depth_raw.astype(np.float32) * np.float32(scale)
+
+    depth_image[(depth_image < min_depth) | (depth_image > max_depth)] = 0.0
+    return depth_image
+
+class StampedMessageBuffer:
+    """
+    Class for pairing messages by header stamp, using a bounded ring buffer of raw (unconverted) messages.
+    """
+
+    def __init__(self, tolerance, buffer_size):
+
+        self.tolerance_ns = int(tolerance * 1e9)
+        self.buffer = collections.deque(maxlen=buffer_size)
+
+
+    def add(self, msg):
+        """
+        Function for adding a message to the ring buffer. The oldest message is dropped when the buffer is full.
+        """
+        self.buffer.append(msg)
+
+
+    def newest_stamp_ns(self):
+        """
+        Function for getting the stamp of the newest buffered message in nanoseconds, or None if the buffer is empty.
+        """
+        if not self.buffer:
+            return None
+        return stamp_to_nanoseconds(self.buffer[-1].header.stamp)
+
+
+    def match(self, stamp):
+        """
+        Function for popping the buffered message closest in time to 'stamp', if it lies within the tolerance.
+        Messages older than the match are discarded as well, since they can never be paired with a newer stamp.
+        """
+        target_ns = stamp_to_nanoseconds(stamp)
+
+        best_index = None
+        best_diff = None
+        for index, msg in enumerate(self.buffer):
+            diff = abs(stamp_to_nanoseconds(msg.header.stamp) - target_ns)
+            if diff <= self.tolerance_ns and (best_diff is None or diff < best_diff):
+                best_index = index
+                best_diff = diff
+
+        if best_index is None:
+            return None
+
+        for _ in range(best_index):
+            self.buffer.popleft()
+        return self.buffer.popleft()
+
+
+# Inference backends the segmentation model can be run through
+INFERENCE_BACKENDS = ('torch', 'onnx', 'openvino')
+
+# Inference resolutions the segmentation model can be run at, from cheapest to most accurate
+IMGSZ_PRESETS = (320, 480, 640)
+
+# Reduced precision the exported model can be run at. FP16 needs the 'openvino' backend, INT8 the 'onnx' backend
+QUANTIZATION_MODES = ('none', 'fp16', 'int8_dynamic', 'int8_static')
+
+
+def read_frames(frames_dir, max_frames=None):
+    """
+    Function for reading recorded BGR frames (.png/.jpg) from a folder, in file name order.
+
+    Args:
+        frames_dir (str): Folder with the recorded frames.
+        max_frames (int or None): Maximum number of frames to read, or None for all of them.
+
+    Returns:
+        list: BGR images as (H, W, 3) uint8 arrays.
+    """
+    import cv2
+
+    file_names = sorted(name for name in os.listdir(frames_dir) if name.lower().endswith(('.png', '.jpg', '.jpeg')))
+    frames = []
+    for file_name in file_names[:max_frames]:
+        frame = cv2.imread(os.path.join(frames_dir, file_name))
+        if frame is not None:
+            frames.append(frame)
+    return frames
+
+
+def letterbox_image(image, imgsz):
+    """
+    Function for turning a BGR image into the (1, 3, imgsz, imgsz) float32 input of an exported YOLO model,
+    letterboxed the same way ultralytics does it before inference.
+
+    Args:
+        image (np.ndarray): BGR image of shape (H, W, 3).
+        imgsz (int): Inference resolution of the exported model.
+
+    Returns:
+        np.ndarray: RGB model input scaled to [0, 1].
+    """
+    import cv2
+
+    height, width = image.shape[:2]
+    gain = min(imgsz / height, imgsz / width)
+    new_height, new_width = int(round(height * gain)), int(round(width * gain))
+    pad_y, pad_x = (imgsz - new_height) // 2, (imgsz - new_width) // 2
+
+    letterboxed = np.full((imgsz, imgsz, 3), 114, dtype=np.uint8)
+    letterboxed[pad_y:pad_y + new_height, pad_x:pad_x + new_width] = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+
+    return np.ascontiguousarray(letterboxed[:, :, ::-1].transpose(2, 0, 1)[None], dtype=np.float32) / 255.0
+
+
+class FrameCalibrationReader:
+    """
+    Class feeding recorded frames to onnxruntime's static quantization, one letterboxed frame at a time.
+    """
+
+    def __init__(self, frames_dir, input_name, imgsz, max_frames=100):
+
+        self.input_name = input_name
+        self.imgsz = imgsz
+        self.frames = read_frames(frames_dir, max_frames)
+        self.index = 0
+
+        if not self.frames:
+            raise ValueError(f"No calibration frames found in '{frames_dir}'")
+
+    def get_next(self):
+        """
+        Method returning the input feed of the next calibration frame, or None once all frames have been used.
+        """
+        if self.index >= len(self.frames):
+            return None
+
+        frame = self.frames[self.index]
+        self.index += 1
+        return {self.input_name: letterbox_image(frame, self.imgsz)}
+
+    def rewind(self):
+        """
+        Method starting over from the first calibration frame.
+        """
+        self.index = 0
+
+
+def quantize_onnx_model(fp32_path, quantized_path, quantization, imgsz, calibration_dir=None):
+    """
+    Function for quantizing an exported ONNX model to INT8 with onnxruntime.
+
+    Dynamic quantization only converts the weights and quantizes activations on the fly. Static quantization
+    also fixes the activation ranges ahead of time, calibrated on a folder of recorded frames.
+
+    Args:
+        fp32_path (str): Path of the full precision ONNX model.
+        quantized_path (str): Path the quantized ONNX model is written to.
+        quantization (str): 'int8_dynamic' or 'int8_static'.
+        imgsz (int): Inference resolution the model was exported for.
+        calibration_dir (str or None): Folder with recorded frames, required for 'int8_static'.
+    """
+    import onnxruntime
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    if quantization == 'int8_dynamic':
+        quantize_dynamic(fp32_path, quantized_path, weight_type=QuantType.QUInt8)
+        return
+
+    if not calibration_dir:
+        raise ValueError("Static INT8 quantization needs a folder of calibration frames")
+
+    input_name = onnxruntime.InferenceSession(fp32_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+    calibration_reader = FrameCalibrationReader(calibration_dir, input_name, imgsz)
+    quantize_static(fp32_path, quantized_path, calibration_reader, quant_format=QuantFormat.QDQ,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, per_channel=True)
+
+
+def export_model(model_path, backend, cache_dir, imgsz=640, dynamic=False, quantization='none', calibration_dir=None):
+    """
+    Function for exporting a PyTorch YOLO model to an inference backend once, caching the exported artifact on disk.
+
+    Args:
+        model_path (str): Path of the PyTorch (.pt) model.
+        backend (str): One of 'INFERENCE_BACKENDS'.
+        cache_dir (str): Folder the exported models are kept in.
+        imgsz (int): Inference resolution the model is exported for.
+        dynamic (bool): Export with dynamic input shapes, which is needed for batched inference.
+        quantization (str): One of 'QUANTIZATION_MODES'.
+        calibration_dir (str or None): Folder with recorded frames, used to calibrate 'int8_static' quantization.
+
+    Returns:
+        str: Path of the model to load for the chosen backend.
+    """
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}', expected one of {INFERENCE_BACKENDS}")
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATION_MODES}")
+    if quantization == 'fp16' and backend != 'openvino':
+        raise ValueError("FP16 quantization is only supported on CPU by the 'openvino' backend")
+    if quantization.startswith('int8') and backend != 'onnx':
+        raise ValueError("INT8 quantization is only supported by the 'onnx' backend")
+
+    if backend == 'torch':
+        return model_path
+
+    # The export options are part of the file name, so changing them never picks up a stale artifact
+    model_name = os.path.splitext(os.path.basename(model_path))[0]
+    model_name += f"_{imgsz}" + ("_dynamic" if dynamic else "") + (f"_{quantization}" if quantization != 'none' else "")
+    suffix = '.onnx' if backend == 'onnx' else '_openvino_model'  # ultralytics detects the backend by this suffix
+    cached_path = os.path.join(cache_dir, model_name + suffix)
+
+    if os.path.exists(cached_path):
+        return cached_path
+
+    if quantization.startswith('int8'):
+        # INT8 models are quantized from the cached full precision export
+        fp32_path = export_model(model_path, backend, cache_dir, imgsz=imgsz, dynamic=dynamic)
+        quantize_onnx_model(fp32_path, cached_path, quantization, imgsz, calibration_dir)
+        return cached_path
+
+    from ultralytics import YOLO
+
+    os.makedirs(cache_dir, exist_ok=True)
+    exported_path = YOLO(model_path, task='segment').export(format=backend, imgsz=imgsz, dynamic=dynamic, half=(quantization == 'fp16'))
+    shutil.move(exported_path, cached_path)
+
+    return cached_path
+
+
+class YoloSegmenter:
+    """
+    Class wrapping a YOLO segmentation model and turning its results into masks of the labels we care about.
+    """
+
+    def __init__(self, model_path, device, confidence, label_mapping, imgsz=640):
+
+        # Imported here, so only the threads or processes actually running inference pay for loading ultralytics
+        from ultralytics import YOLO
+
+        self.device = device
+        self.CONFIDENCE = confidence
+        self.IMGSZ = imgsz
+        self.label_mapping = label_mapping
+        self.model = YOLO(model_path, task='segment', verbose=False)  # Load the YOLO model for segmentation
+
+        # Class indices of the labels we care about, so the predictor discards everything else before building masks
+        self.class_ids = [index for index, name in self.model.names.items() if name in self.label_mapping]
+
+        # Counters collected by the inference pool through 'pop_stats'
+        self.stats = collections.Counter()
+
+
+    def warmup(self, height=480, width=640):
+        """
+        Function for running the model once on a synthetic frame, so lazy initialization is not paid by the first real frame.
+        """
+        self.segment_batch([np.zeros((height, width, 3), dtype=np.uint8)])
+        self.pop_stats()  # The warm-up is not part of the statistics
+
+
+    def pop_stats(self):
+        """
+        Function for getting and resetting the number of segmented frames and the time spent in inference.
+        """
+        stats = dict(self.stats)
+        self.stats.clear()
+        return stats
+
+
+    def segment_image(self, image):
+        """
+        Function for performing YOLO-based segmentation on an RGB image.
+
+        Returns:
+            tuple: The input image and the list of detected instances (see 'segment_batch').
+        """
+        return image, self.segment_batch([image])[0]
+
+
+    def segment_batch(self, images):
+        """
+        Function for performing YOLO-based segmentation on a batch of RGB images with a single call to the model.
+
+        Every detected object becomes its own instance, so two chairs in one frame yield two instances. An instance
+        is a dictionary with the keys:
+            'label' (str): Name of the detected class.
+            'confidence' (float): Detection confidence.
+            'bbox' (tuple): Bounding box (x_min, y_min, x_max, y_max) in input image pixels.
+            'mask' (np.ndarray): Boolean mask at the model's letterboxed resolution, cropped to 'mask_bbox'.
+            'mask_bbox' (tuple): Region (x_min, y_min, x_max, y_max) of the model mask covered by 'mask', exclusive maximum.
+            'mask_shape' (tuple): Shape (height, width) of the full model mask.
+            'image_shape' (tuple): Shape (height, width) of the input image.
+
+        The masks still have to be mapped into depth image coordinates with 'align_instances_to_depth'.
+
+        Returns:
+            list: One list of instances per image.
+        """
+        start = time.perf_counter()
+        results = self.model.predict(images, device=self.device, task='segment', imgsz=self.IMGSZ,
+                                     classes=self.class_ids or None, conf=self.CONFIDENCE)
+        self.stats['frames'] += len(images)
+        self.stats['inference_time'] += time.perf_counter() - start
+
+        batch_instances = []
+
+        for result in results:
+            instances = []
+            batch_instances.append(instances)
+
+            if result.masks is None:  # Skip if no masks are found
+                continue
+
+            image_shape = tuple(result.orig_shape)
+            mask_shape = tuple(result.masks.data.shape[1:])
+            gain, pad_x, pad_y = letterbox_transform(mask_shape, image_shape)
+
+            # Process detected masks and bounding boxes
+            for mask, box in zip(result.masks.data, result.boxes):
+                confidence = float(box.conf[0])
+                label_index = int(box.cls[0])
+                label = self.model.names[label_index]
+
+                # Include only objects with high confidence and relevant labels
+                if confidence > self.CONFIDENCE and label in self.label_mapping:
+                    x_min, y_min, x_max, y_max = box.xyxy[0].tolist()
+
+                    # Bounding box in model mask coordinates
+                    mask_bbox = (max(0, int(x_min * gain + pad_x)), max(0, int(y_min * gain + pad_y)),
+                                 min(mask_shape[1], int(math.ceil(x_max * gain + pad_x))),
+                                 min(mask_shape[0], int(math.ceil(y_max * gain + pad_y))))
+
+                    # Only the bounding box region of the mask is copied off the device
+                    mask_cropped = mask[mask_bbox[1]:mask_bbox[3], mask_bbox[0]:mask_bbox[2]].cpu().numpy() > 0.5
+
+                    instances.append({
+                        'label': label,
+                        'confidence': confidence,
+                        'bbox': (x_min, y_min, x_max, y_max),
+                        'mask': mask_cropped,
+                        'mask_bbox': mask_bbox,
+                        'mask_shape': mask_shape,
+                        'image_shape': image_shape,
+                    })
+
+        return batch_instances
+
+
+class TwoTierSegmenter:
+    """
+    Class running a light primary segmenter on every frame, and escalating to a heavy segmenter only for frames where
+    the primary segmenter is uncertain about one of our labels.
+
+    The primary segmenter runs with its confidence threshold lowered to the bottom of the escalation band, so it also
+    reports the detections it is unsure about. A frame is escalated when any detection lies within 'escalation_band'
+    of 'confidence'. Otherwise the primary detections above 'confidence' are used as they are.
+    """
+
+    def __init__(self, primary_model_path, escalation_model_path, device, confidence, label_mapping, imgsz, escalation_band):
+
+        self.CONFIDENCE = confidence
+        self.ESCALATION_BAND = escalation_band
+
+        self.primary = YoloSegmenter(primary_model_path, device, max(0.0, confidence - escalation_band), label_mapping, imgsz)
+        self.escalation = YoloSegmenter(escalation_model_path, device, confidence, label_mapping, imgsz)
+
+        # Counters collected by the inference pool through 'pop_stats'
+        self.stats = collections.Counter()
+
+
+    def warmup(self, height=480, width=640):
+        """
+        Function for warming up both tiers on a synthetic frame.
+        """
+        self.primary.warmup(height, width)
+        self.escalation.warmup(height, width)
+
+
+    def pop_stats(self):
+        """
+        Function for getting and resetting the number of segmented and escalated frames and the time spent in each tier.
+        """
+        self.primary.pop_stats()
+        self.escalation.pop_stats()
+
+        stats = dict(self.stats)
+        self.stats.clear()
+        return stats
+
+
+    def segment_image(self, image):
+        """
+        Function for performing two-tier segmentation on an RGB image.
+
+        Returns:
+            tuple: The input image and the list of detected instances (see 'YoloSegmenter.segment_batch').
+        """
+        return image, self.segment_batch([image])[0]
+
+
+    def segment_batch(self, images):
+        """
+        Function for performing two-tier segmentation on a batch of RGB images. Escalated frames are sent to the
+        heavy segmenter together, as one batch.
+
+        Returns:
+            list: One list of instances per image.
+        """
+        start = time.perf_counter()
+        batch_instances = self.primary.segment_batch(images)
+        self.stats['frames'] += len(images)
+        self.stats['primary_time'] += time.perf_counter() - start
+
+        escalated_indices = []
+        for index, instances in enumerate(batch_instances):
+            if any(abs(instance['confidence'] - self.CONFIDENCE) <= self.ESCALATION_BAND for instance in instances):
+                escalated_indices.append(index)
+            else:
+                batch_instances[index] = [instance for instance in instances if instance['confidence'] > self.CONFIDENCE]
+
+        if escalated_indices:
+            start = time.perf_counter()
+            escalated_instances = self.escalation.segment_batch([images[index] for index in escalated_indices])
+            self.stats['escalated_frames'] += len(escalated_indices)
+            self.stats['escalation_time'] += time.perf_counter() - start
+
+            for index, instances in zip(escalated_indices, escalated_instances):
+                batch_instances[index] = instances
+
+        return batch_instances
+
+
+# Segmenter replica owned by an inference worker process
+_worker_segmenter = None
+
+
+def _init_worker_segmenter(segmenter_factory):
+    """
+    Function for loading the segmenter replica of an inference worker process.
+    """
+    global _worker_segmenter
+    _worker_segmenter = segmenter_factory()
+    _worker_segmenter.warmup()
+
+
+def _worker_ready():
+    """
+    Function run once in a new inference worker process, forcing it to start and load its segmenter replica.
+    """
+    return _worker_segmenter is not None
+
+
+def _segment_batch_in_worker(images):
+    """
+    Function for running the segmenter replica of an inference worker process on a batch of images.
+
+    Returns:
+        tuple: The instances of every image and the statistics of the segmenter since the previous batch.
+    """
+    return _worker_segmenter.segment_batch(images), _worker_segmenter.pop_stats()
+
+
+class InferenceWorkerPool:
+    """
+    Class for running segmenter replicas in a pool of worker threads or processes, fed by a bounded frame queue.
+
+    Frames are handed to the pool together with an opaque context (e.g. header stamp and depth message), which is
+    returned alongside the segmentation output, so the caller can back-project and publish the result later.
+
+    With 'max_batch_size' above 1, a worker collects up to that many frames, waiting at most 'max_batch_wait'
+    seconds for more to arrive, and runs the model once on the whole batch.
+    """
+
+    POOL_TYPES = ('thread', 'process')
+    DROP_POLICIES = ('drop_oldest', 'drop_newest')
+
+    def __init__(self, segmenter_factory, num_workers, pool_type, queue_size, drop_policy, max_batch_size=1, max_batch_wait=0.0):
+
+        if pool_type not in self.POOL_TYPES:
+            raise ValueError(f"Unknown inference pool type '{pool_type}', expected one of {self.POOL_TYPES}")
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy '{drop_policy}', expected one of {self.DROP_POLICIES}")
+
+        self.POOL_TYPE = pool_type
+        self.DROP_POLICY = drop_policy
+        self.MAX_BATCH_SIZE = max(1, max_batch_size)
+        self.MAX_BATCH_WAIT = max_batch_wait
+        self.NUM_WORKERS = max(1, num_workers)
+
+        # The queue must be able to hold a full batch, otherwise batches could never form
+        self.QUEUE_SIZE = max(1, queue_size, self.MAX_BATCH_SIZE)
+
+        self.pending = collections.deque()  # Frames waiting for a free worker
+        self.results = queue.Queue()  # Finished frames waiting to be collected by the caller
+        self.condition = threading.Condition()
+        self.running = True
+        self.dropped_frames = 0
+        self.segmenter_stats = collections.Counter()  # Statistics summed over all segmenter replicas
+        self.ready_workers = 0  # Workers whose segmenter replica is loaded and warmed up
+        self.failed_workers = 0  # Workers whose segmenter replica failed to load, they never serve frames
+        self.load_errors = []  # Exceptions of the failed workers
+        self.ready = threading.Event()  # Set once every worker is ready to serve frames at steady-state latency
+        self.started = threading.Event()  # Set once every worker is either ready or failed
+
+        self.workers = []
+        for index in range(self.NUM_WORKERS):
+            worker = threading.Thread(target=self._worker_loop, args=(segmenter_factory,),
+                                      name=f"inference_worker_{index}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+
+    def wait_until_ready(self, timeout=None):
+        """
+        Function for blocking until every worker has loaded and warmed up its segmenter replica, or failed to.
+        Returns as soon as the last worker finished starting, so a failed load does not block until the timeout.
+
+        Returns:
+            bool: True if every worker is ready, False if a worker failed or the timeout expired first.
+                  'ready_workers' and 'load_errors' tell the two apart.
+        """
+        self.started.wait(timeout)
+        return self.ready.is_set()
+
+
+    def submit(self, image, context):
+        """
+        Function for queueing a frame for inference.
+
+        When the queue is full, 'drop_oldest' discards the oldest queued frame so the newest frame wins,
+        while 'drop_newest' rejects the incoming frame.
+
+        Returns:
+            The context of the frame that was dropped, or None if no frame was dropped.
+        """
+        with self.condition:
+            dropped_context = None
+            if len(self.pending) >= self.QUEUE_SIZE:
+                self.dropped_frames += 1
+                if self.DROP_POLICY == 'drop_newest':
+                    return context
+                _, dropped_context = self.pending.popleft()
+
+            self.pending.append((image, context))
+            self.condition.notify()
+
+        return dropped_context
+
+
+    def get_results(self):
+        """
+        Function for collecting all finished frames without blocking.
+
+        Returns:
+            list: Tuples of (context, instances, error). 'error' is None when inference succeeded.
+        """
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+
+    def pop_segmenter_stats(self):
+        """
+        Function for getting and resetting the statistics reported by the segmenter replicas (see their 'pop_stats').
+        """
+        with self.condition:
+            stats = dict(self.segmenter_stats)
+            self.segmenter_stats.clear()
+        return stats
+
+
+    def shutdown(self):
+        """
+        Function for stopping all workers. Frames still queued are discarded.
+        """
+        with self.condition:
+            self.running = False
+            self.pending.clear()
+            self.condition.notify_all()
+
+        for worker in self.workers:
+            worker.join(timeout=5.0)
+
+
+    def _worker_loop(self, segmenter_factory):
+        """
+        Function run by each worker thread. In 'process' mode the thread drives its own single worker process.
+        """
+        executor = None
+        try:
+            if self.POOL_TYPE == 'process':
+                # 'spawn' avoids forking a parent that already holds torch and rclpy threads
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker_segmenter,
+                    initargs=(segmenter_factory,))
+                segment_batch = lambda images: executor.submit(_segment_batch_in_worker, images).result()
+
+                # Worker processes are only spawned on the first submission, so load and warm up the replica now
+                executor.submit(_worker_ready).result()
+            else:
+                segmenter = segmenter_factory()
+                segmenter.warmup()
+                segment_batch = lambda images: (segmenter.segment_batch(images), segmenter.pop_stats())
+        except Exception as error:
+            with self.condition:
+                self.failed_workers += 1
+                self.load_errors.append(error)
+                if self.ready_workers + self.failed_workers == self.NUM_WORKERS:
+                    self.started.set()
+            return
+
+        with self.condition:
+            self.ready_workers += 1
+            if self.ready_workers == self.NUM_WORKERS:
+                self.ready.set()
+            if self.ready_workers + self.failed_workers == self.NUM_WORKERS:
+                self.started.set()
+
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                if not batch:
+                    continue  # Another worker took the frames while this one was waiting
+
+                images = [image for image, _ in batch]
+                try:
+                    batch_instances, stats = segment_batch(images)
+                    with self.condition:
+                        self.segmenter_stats.update(stats)
+
+                    for (_, context), instances in zip(batch, batch_instances):
+                        self.results.put((context, instances, None))
+                except Exception as error:
+                    for _, context in batch:
+                        self.results.put((context, None, error))
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def _next_batch(self):
+        """
+        Function for taking the next batch of frames off the queue, waiting for frames to arrive.
+
+        Returns:
+            list: Up to 'MAX_BATCH_SIZE' (image, context) tuples, or None when the pool is shutting down.
+        """
+        with self.condition:
+            while self.running and not self.pending:
+                self.condition.wait()
+
+            # Give more frames a chance to arrive until the batch is full or the maximum wait has passed
+            deadline = time.monotonic() + self.MAX_BATCH_WAIT
+            while self.running and len(self.pending) < self.MAX_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            if not self.running:
+                return None
+
+            return [self.pending.popleft() for _ in range(min(len(self.pending), self.MAX_BATCH_SIZE))]
+
+
+class AdaptiveFrameScheduler:
+    """
+    Class for deciding which incoming frames to process, based on a moving average of the measured end-to-end cost
+    (inference, back-projection and publishing) per frame.
+
+    A frame is only processed when fewer than 'max_in_flight' frames are still being worked on, and enough time has
+    passed since the last processed frame to respect both the target processing rate and the CPU budget.
+    """
+
+    def __init__(self, target_rate, cpu_budget, smoothing, max_in_flight=1):
+
+        self.TARGET_RATE = target_rate  # Maximum number of processed frames per second, 0 for unlimited
+        self.CPU_BUDGET = cpu_budget  # Fraction of wall time the pipeline may spend processing frames
+        self.SMOOTHING = smoothing  # Weight of the newest measurement in the moving average
+        self.MAX_IN_FLIGHT = max(1, max_in_flight)
+
+        self.average_cost = None  # Moving average of the end-to-end cost per frame in seconds
+        self.in_flight = 0
+        self.last_start = None
+
+        # Counters exposed through 'get_metrics'
+        self.processed_frames = 0
+        self.skipped_frames = 0
+        self.dropped_frames = 0
+        self.metrics_time = time.monotonic()
+        self.metrics_processed_frames = 0
+
+
+    def min_interval(self):
+        """
+        Function for getting the minimum time in seconds between the start of two processed frames.
+        """
+        interval = 1.0 / self.TARGET_RATE if self.TARGET_RATE > 0 else 0.0
+
+        if self.average_cost is not None and self.CPU_BUDGET > 0:
+            # With several frames in flight the cost is spread over the workers
+            interval = max(interval, self.average_cost / (self.CPU_BUDGET * self.MAX_IN_FLIGHT))
+
+        return interval
+
+
+    def should_process(self, now=None):
+        """
+        Function for checking whether an incoming frame should be processed. Frames that are not are counted as skipped.
+        """
+        now = time.monotonic() if now is None else now
+
+        if not self.has_capacity() or (
+                self.last_start is not None and now - self.last_start < self.min_interval()):
+            self.frame_skipped()
+            return False
+
+        return True
+
+
+    def has_capacity(self):
+        """
+        Function for checking whether another frame may be started without exceeding 'max_in_flight'.
+        """
+        return self.in_flight < self.MAX_IN_FLIGHT
+
+
+    def frame_skipped(self):
+        """
+        Function for marking that an incoming frame was not processed.
+        """
+        self.skipped_frames += 1
+
+
+    def frame_started(self, now=None):
+        """
+        Function for marking that processing of a frame started.
+
+        Returns:
+            float: Start time, to be handed back to 'frame_finished'.
+        """
+        now = time.monotonic() if now is None else now
+        self.in_flight += 1
+        self.last_start = now
+        return now
+
+
+    def frame_finished(self, start_time, now=None):
+        """
+        Function for marking that a frame was fully processed, updating the moving average of the cost per frame.
+        """
+        now = time.monotonic() if now is None else now
+        cost = now - start_time
+
+        if self.average_cost is None:
+            self.average_cost = cost
+        else:
+            self.average_cost = self.SMOOTHING * cost + (1.0 - self.SMOOTHING) * self.average_cost
+
+        self.in_flight = max(0, self.in_flight - 1)
+        self.processed_frames += 1
+
+
+    def frame_dropped(self):
+        """
+        Function for marking that a started frame was dropped before it was fully processed.
+        """
+        self.in_flight = max(0, self.in_flight - 1)
+        self.dropped_frames += 1
+
+
+    def get_metrics(self, now=None):
+        """
+        Function for getting the scheduler metrics. The achieved rate is measured since the previous call.
+
+        Returns:
+            dict: Achieved rate, average cost, current minimum interval and frame counters.
+        """
+        now = time.monotonic() if now is None else now
+        elapsed = now - self.metrics_time
+        achieved_rate = (self.processed_frames - self.metrics_processed_frames) / elapsed if elapsed > 0 else 0.0
+
+        self.metrics_time = now
+        self.metrics_processed_frames = self.processed_frames
+
+        return {
+            'achieved_rate': achieved_rate,
+            'average_cost': self.average_cost,
+            'min_interval': self.min_interval(),
+            'in_flight': self.in_flight,
+            'processed_frames': self.processed_frames,
+            'skipped_frames': self.skipped_frames,
+            'dropped_frames': self.dropped_frames,
+        }
+
+
+class KeyframeSelector:
+    """
+    Class for deciding whether the robot moved enough since the last processed frame to make a new frame worth segmenting.
+
+    A frame is a keyframe when the translation or rotation since the last keyframe exceeds its threshold, or when
+    'refresh_period' seconds have passed since the last keyframe. Without any pose, every frame is a keyframe.
+    """
+
+    def __init__(self, translation_threshold, rotation_threshold, refresh_period):
+
+        self.TRANSLATION_THRESHOLD = translation_threshold  # Metres
+        self.ROTATION_THRESHOLD = rotation_threshold  # Radians
+        self.REFRESH_PERIOD = refresh_period  # Seconds
+
+        self.position = None  # Latest robot position as np.ndarray (x, y, z)
+        self.orientation = None  # Latest robot orientation as np.ndarray quaternion (x, y, z, w)
+        self.keyframe_position = None
+        self.keyframe_orientation = None
+        self.keyframe_time = None
+        self.skipped_frames = 0
+
+
+    def update_pose(self, pose):
+        """
+        Function for storing the latest robot pose from a 'geometry_msgs/Pose'.
+        """
+        self.position = np.array([pose.position.x, pose.position.y, pose.position.z])
+        self.orientation = np.array([pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w])
+
+
+    def is_keyframe(self, now=None):
+        """
+        Function for checking whether the current frame is a keyframe. Frames that are not are counted as skipped.
+        """
+        now = time.monotonic() if now is None else now
+
+        if self.keyframe_time is None or self.position is None or self.keyframe_position is None:
+            return True
+
+        if now - self.keyframe_time >= self.REFRESH_PERIOD:
+            return True
+
+        translation = np.linalg.norm(self.position - self.keyframe_position)
+
+        # Angle between the two orientations, from the dot product of the unit quaternions
+        dot = abs(float(np.dot(self.orientation, self.keyframe_orientation)))
+        rotation = 2.0 * math.acos(min(1.0, dot))
+
+        if translation > self.TRANSLATION_THRESHOLD or rotation > self.ROTATION_THRESHOLD:
+            return True
+
+        self.skipped_frames += 1
+        return False
+
+
+    def mark_keyframe(self, now=None):
+        """
+        Function for marking that the current frame is processed, making the current pose the new reference.
+
+        Returns:
+            tuple: The previous reference, to be handed to 'restore_keyframe' if the frame is dropped after all.
+        """
+        previous = (self.keyframe_time, self.keyframe_position, self.keyframe_orientation)
+        self.keyframe_time = time.monotonic() if now is None else now
+        self.keyframe_position = self.position
+        self.keyframe_orientation = self.orientation
+        return previous
+
+
+    def restore_keyframe(self, previous, marked_time):
+        """
+        Function for undoing 'mark_keyframe' of a frame that was dropped before it was processed, unless a later frame
+        has been marked since. 'marked_time' is the time the dropped frame was marked at.
+        """
+        if self.keyframe_time == marked_time:
+            self.keyframe_time, self.keyframe_position, self.keyframe_orientation = previous
+
+
+class MaskPropagator:
+    """
+    Class for propagating the instances of the last full segmentation to new frames with sparse optical flow, so the
+    full segmenter only has to run every 'detection_interval' frames or when the image changed too much.
+
+    Each instance is shifted by the median Lucas-Kanade flow of the corner features inside its bounding box.
+    """
+
+    TRACKING_SCALE = 0.5  # Images are tracked at half resolution
+    MAX_FEATURES = 50  # Corner features tracked per instance
+
+    def __init__(self, detection_interval, change_threshold):
+
+        self.DETECTION_INTERVAL = max(1, detection_interval)
+        self.CHANGE_THRESHOLD = change_threshold  # Mean absolute grey level difference, from 0 to 1
+
+        self.frames_since_detection = None
+        self.reference_gray = None  # Downscaled grey image of the last segmented frame
+        self.reference_instances = []
+        self.reference_features = []  # Corner features of each reference instance, at tracking scale
+        self.tracked_frames = 0
+        self.detected_frames = 0
+
+
+    def to_gray(self, image):
+        """
+        Function for converting a BGR image into the downscaled grey image used for tracking.
+        """
+        import cv2
+
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, None, fx=self.TRACKING_SCALE, fy=self.TRACKING_SCALE, interpolation=cv2.INTER_AREA)
+
+
+    def change_score(self, gray):
+        """
+        Function for scoring how much a frame changed compared to the reference frame, from 0 to 1.
+        """
+        import cv2
+
+        return float(cv2.absdiff(gray, self.reference_gray).mean()) / 255.0
+
+
+    def needs_detection(self, gray):
+        """
+        Function for deciding whether a frame must go through the full segmenter instead of being tracked.
+        """
+        if self.reference_gray is None or self.frames_since_detection is None:
+            return True
+        if self.frames_since_detection + 1 >= self.DETECTION_INTERVAL:
+            return True
+        return self.change_score(gray) > self.CHANGE_THRESHOLD
+
+
+    def detection_submitted(self):
+        """
+        Function for marking that a frame was handed to the full segmenter.
+
+        Returns:
+            tuple: Token to be handed to 'detection_dropped' if the frame is dropped before it is segmented.
+        """
+        previous = self.frames_since_detection
+        self.frames_since_detection = 0
+        self.detected_frames += 1
+        return previous, self.detected_frames
+
+
+    def detection_dropped(self, token):
+        """
+        Function for undoing 'detection_submitted' of a frame that was dropped before it was segmented, so the next
+        frame is due for detection as it would have been. Nothing is undone if a later detection was submitted since.
+        """
+        previous, submitted = token
+        if self.detected_frames == submitted:
+            self.frames_since_detection = previous
+
+
+    def set_reference(self, gray, instances):
+        """
+        Function for making a segmented frame the reference that the next frames are tracked from.
+        """
+        import cv2
+
+        self.reference_gray = gray
+        self.reference_instances = instances
+        self.reference_features = []
+
+        for instance in instances:
+            x_min, y_min, x_max, y_max = (int(value * self.TRACKING_SCALE) for value in instance['bbox'])
+            roi = np.zeros(gray.shape, dtype=np.uint8)
+            roi[max(0, y_min):y_max + 1, max(0, x_min):x_max + 1] = 255
+
+            features = cv2.goodFeaturesToTrack(gray, self.MAX_FEATURES, 0.01, 5, mask=roi)
+            self.reference_features.append(features)
+
+
+    def propagate(self, gray):
+        """
+        Function for moving the reference instances into a new frame.
+
+        Returns:
+            list: Copies of the reference instances with shifted 'bbox' and 'mask_bbox'. Instances whose features
+            could not be tracked are left out.
+        """
+        import cv2
+
+        self.frames_since_detection = (self.frames_since_detection or 0) + 1
+        self.tracked_frames += 1
+
+        tracked_instances = []
+
+        for instance, features in zip(self.reference_instances, self.reference_features):
+            if features is None:
+                continue
+
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(self.reference_gray, gray, features, None)
+            tracked = status.reshape(-1) == 1
+            if not tracked.any():
+                continue
+
+            # Median displacement of the tracked features, in input image pixels
+            dx, dy = np.median((moved - features).reshape(-1, 2)[tracked], axis=0) / self.TRACKING_SCALE
+
+            gain, _, _ = letterbox_transform(instance['mask_shape'], instance['image_shape'])
+            mask_dx, mask_dy = int(round(dx * gain)), int(round(dy * gain))
+
+            x_min, y_min, x_max, y_max = instance['bbox']
+            mask_x_min, mask_y_min, mask_x_max, mask_y_max = instance['mask_bbox']
+
+            tracked_instance = dict(instance)
+            tracked_instance['bbox'] = (x_min + dx, y_min + dy, x_max + dx, y_max + dy)
+            tracked_instance['mask_bbox'] = (mask_x_min + mask_dx, mask_y_min + mask_dy, mask_x_max + mask_dx, mask_y_max + mask_dy)
+            tracked_instance['tracked'] = True
+            tracked_instances.append(tracked_instance)
+
+        return tracked_instances
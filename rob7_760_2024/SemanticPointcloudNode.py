@@ -1,24 +1,31 @@
-from rob7_760_2024.LIB import JSON_Handler
+from rob7_760_2024.LIB import JSON_Handler, LabeledPointStore, VoxelHashIndex, read_labeled_points, transform_points, transform_to_matrix
 
 import rclpy
 from rclpy.node import Node
 from sensor_msgs.msg import PointCloud2, PointField
-from geometry_msgs.msg import PointStamped
 import tf2_ros
-from tf2_geometry_msgs import do_transform_point
 from std_msgs.msg import Bool
-import sensor_msgs_py.point_cloud2 as pc2
 
-import struct
-import math
-import random
+import numpy as np
+import collections
 
 class SemanticPointcloudNode(Node):
-    def __init__(self, sampling_percentage, time_diff, distance_threshold):
+    def __init__(self, sampling_percentage, time_diff, distance_threshold,
+                 pending_buffer_size, pending_max_age, pending_retry_period,
+                 publish_mode, publish_rate, keyframe_period):
         # Initializing parsed variables.
         self.SAMPLING_PERCENTAGE = sampling_percentage
         self.TIME_DIFF = time_diff
         self.DISTANCE_THRESHOLD = distance_threshold
+        self.PENDING_BUFFER_SIZE = pending_buffer_size
+        self.PENDING_MAX_AGE = pending_max_age
+        self.PENDING_RETRY_PERIOD = pending_retry_period
+        self.PUBLISH_MODE = publish_mode
+        self.PUBLISH_RATE = publish_rate
+        self.KEYFRAME_PERIOD = keyframe_period
+
+        if self.PUBLISH_MODE not in ('snapshot', 'delta'):
+            raise ValueError(f"PUBLISH_MODE must be 'snapshot' or 'delta', got '{self.PUBLISH_MODE}'")
 
         # Initializing the 'Node' class, from which this class is inheriting, with argument 'node_name'.
         Node.__init__(self, 'semantic_pointcloud_node')
@@ -37,140 +44,170 @@ class SemanticPointcloudNode(Node):
         
         self.robot_reached_goal_subscriber = self.create_subscription(Bool, '/robot_reached_goal', self.robot_reached_goal_callback, 10)
 
-        # Publisher for the transformed points as PointCloud2
+        # Publisher for the transformed points as PointCloud2. In 'delta' mode this topic only carries the periodic
+        # full snapshots (keyframes), which replace everything received before
         self.point_cloud_pub = self.create_publisher(PointCloud2, '/transformed_points', 10)
 
-        # Create a TF buffer and listener to get the transforms
+        # Publisher for the points added since the previous publish, used in 'delta' mode
+        self.point_cloud_delta_pub = self.create_publisher(PointCloud2, '/transformed_points/delta', 10)
+
+        # Create a TF buffer and listener to get the transforms, kept for the lifetime of the node
         self.tf_buffer = tf2_ros.Buffer(rclpy.duration.Duration(seconds=100))
+        self.tf_listener = tf2_ros.TransformListener(self.tf_buffer, self)
+
+        # Clouds waiting for their transform to arrive, oldest first, retried by a timer until they are too old
+        self.pending_clouds = collections.deque()
+        self.dropped_clouds = 0
+        self.pending_timer = self.create_timer(self.PENDING_RETRY_PERIOD, self.process_pending_clouds)
+
+        # Columnar store of the transformed points with labels, published straight from its memory
+        self.transformed_points = LabeledPointStore()
+        self.rng = np.random.default_rng()  # Random generator for sampling the incoming points
+
+        # Spatial hash over the rows of the store, so proximity checks only look at the neighbouring cells
+        self.point_index = VoxelHashIndex(self.DISTANCE_THRESHOLD, self.transformed_points)
 
-        # List to store transformed points with labels
-        self.transformed_points = []
+        # Publishing runs on its own timer, decoupled from how often clouds arrive
+        self.published_size = 0  # Number of stored points already published
+        self.keyframe_due = True  # Publish a full snapshot at the next tick
+        self.last_keyframe_time = self.get_clock().now()
+        self.publish_timer = self.create_timer(1.0 / self.PUBLISH_RATE, self.publish_timer_callback)
 
     def robot_reached_goal_callback(self, msg):
         self.logger.debug(f"Recieved robot_reached_goal_callback msg.data: '{msg.data}'")
-        self.transformed_points = []
+        self.point_index.clear()  # Clears the store of transformed points as well
+
+        # Consumers must drop their points as well, so the next publish is an (empty) snapshot
+        self.published_size = 0
+        self.keyframe_due = True
 
     def pointcloud_callback(self, msg):
         """
         Callback for the /object_detected/pointcloud topic.
-        Processes points and transforms them to the map frame.
+        Queues the cloud until its transform to the map frame is available.
+        """
+        if len(self.pending_clouds) >= self.PENDING_BUFFER_SIZE:
+            self.pending_clouds.popleft()
+            self.dropped_clouds += 1
+            self.logger.debug(f"Pending cloud buffer full, dropped the oldest cloud ({self.dropped_clouds} dropped so far).")
+
+        self.pending_clouds.append(msg)
+        self.process_pending_clouds()
+
+    def process_pending_clouds(self):
+        """
+        Processes every pending cloud whose transform has become available, and drops the ones older than PENDING_MAX_AGE.
+        """
+        if not self.pending_clouds:
+            return
+
+        now = self.get_clock().now()
+        still_pending = collections.deque()
+
+        for msg in self.pending_clouds:
+            msg_time = rclpy.time.Time.from_msg(msg.header.stamp)
+
+            # Non-blocking check, the timer comes back for clouds whose transform is not there yet
+            transform = None
+            if self.tf_buffer.can_transform('map', msg.header.frame_id, msg_time):
+                try:
+                    transform = self.tf_buffer.lookup_transform('map', msg.header.frame_id, msg_time)
+                except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException) as error:
+                    # The lookup can still fail, e.g. when the buffer changed in between, so the cloud is retried like any other
+                    self.logger.debug(f"Transform lookup failed: {error}. Retrying the cloud later.")
+
+            if transform is not None:
+                self.process_pointcloud(msg, transform)
+
+            elif (now - msg_time).nanoseconds > self.PENDING_MAX_AGE * 1e9:
+                self.dropped_clouds += 1
+                self.logger.debug(f"No transform within {self.PENDING_MAX_AGE} s for cloud in frame '{msg.header.frame_id}', dropping it.")
+
+            else:
+                still_pending.append(msg)
+
+        self.pending_clouds = still_pending
+
+    def process_pointcloud(self, msg, transform):
+        """
+        Processes the points of a cloud and transforms them to the map frame.
         """
         # Get the timestamp from the PointCloud2 message
         msg_timestamp = msg.header.stamp
 
-        # Wait for the transform to be available using the PointCloud2's timestamp
-        self.tf_listener = tf2_ros.TransformListener(self.tf_buffer, self)
+        transform_time = transform.header.stamp
 
-        try:
-            #self.logger.debug(f"tf_buffer: '{self.tf_buffer}'")
-            transform = self.tf_buffer.lookup_transform(
-                'map',  # Target frame
-                msg.header.frame_id,  # Source frame
-                rclpy.time.Time.from_msg(msg_timestamp),  # Timestamp from the message
-                timeout=rclpy.duration.Duration(seconds=0.1)  # Adjust timeout as needed
-            )
-
-            transform_time = transform.header.stamp
-
-            # Compute time difference using sec and nanosec
-            time_diff_sec = transform_time.sec - msg_timestamp.sec
-            time_diff_nsec = transform_time.nanosec - msg_timestamp.nanosec
-
-            # If nanosec difference is negative, adjust the seconds
-            if time_diff_nsec < 0:
-                time_diff_sec -= 1
-                time_diff_nsec += 1e9  # Adding one second worth of nanoseconds
-                
-            time_diff = time_diff_sec + time_diff_nsec / 1e9  # Time difference in seconds
-
-            #self.logger.debug(f"Using transform (time diff: {time_diff:.3f} seconds)")
-
-            if time_diff > self.TIME_DIFF:  # If the time difference is greater than 0.1 seconds, skip processing
-                #self.logger.warn(f"Transform is too old ({time_diff:.3f} seconds), skipping point cloud processing.")
-                return
-
-        except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException) as e:
-            #self.logger.warn(f"Transform lookup failed: {e}. Skipping point cloud processing.")
+        # Compute time difference using sec and nanosec
+        time_diff_sec = transform_time.sec - msg_timestamp.sec
+        time_diff_nsec = transform_time.nanosec - msg_timestamp.nanosec
+
+        # If nanosec difference is negative, adjust the seconds
+        if time_diff_nsec < 0:
+            time_diff_sec -= 1
+            time_diff_nsec += 1e9  # Adding one second worth of nanoseconds
+            
+        time_diff = time_diff_sec + time_diff_nsec / 1e9  # Time difference in seconds
+
+        #self.logger.debug(f"Using transform (time diff: {time_diff:.3f} seconds)")
+
+        if time_diff > self.TIME_DIFF:  # If the time difference is greater than TIME_DIFF seconds, skip processing
+            #self.logger.warn(f"Transform is too old ({time_diff:.3f} seconds), skipping point cloud processing.")
             return
         
         # Extract points from the PointCloud2 message
-        points = self.extract_points_from_pointcloud2(msg)
+        xyz, labels = self.extract_points_from_pointcloud2(msg)
 
         # Reduce the number of points by filtering based on proximity
-        points = self.reduce_points(points)
+        xyz, labels = self.reduce_points(xyz, labels)
+        if len(xyz) == 0:
+            return
 
-        # Transform each point and store it
-        for point in points:
-     
-            transformed_point = self.transform_point(point, transform)
-            if transformed_point:  # Check if transformation succeeded
-                
-                # Check if this point is too close to any point in the transformed points list
-                if self.is_point_too_close(transformed_point):
-                   
-                    continue  # Skip the point if it's too close to an existing point
-             
-                # Combine point and label in a single dictionary
-                transformed_point['label'] = point['label']
-             
-                self.transformed_points.append(transformed_point)
-              
-        # Publish the transformed points as PointCloud2
-        self.publish_point_cloud()
+        # Convert the transform once per message, validating it for NaN/Inf a single time
+        try:
+            rotation_matrix, translation = transform_to_matrix(transform)
+        except ValueError as error:
+            self.logger.error(f"{error}. Skipping point cloud processing.")
+            return
+
+        # Transform all points in one go
+        transformed_xyz = transform_points(xyz, rotation_matrix, translation)
+
+        # Store the points which are not too close to an existing point, nor to each other, checked in bulk
+        self.point_index.insert_if_far(transformed_xyz, labels)
 
     def extract_points_from_pointcloud2(self, msg):
         """
-        Extracts points with labels from a PointCloud2 message.
+        Extracts points with labels from a PointCloud2 message, as (N, 3) coordinates and (N,) label ids.
         """
-        points = []
-        for point in pc2.read_points(msg, field_names=('x', 'y', 'z', 'label'), skip_nans=True):
-            x, y, z, label = point
-            points.append({'x': x, 'y': y, 'z': z, 'label': int(label)})
-        return points
+        return read_labeled_points(msg, skip_nans=True)
     
-    def transform_point(self, point, transform):
+    def publish_timer_callback(self):
         """
-        Transforms a point from the source frame to the target frame.
+        Timer callback publishing the transformed points at PUBLISH_RATE.
+        'snapshot' publishes the full map whenever it changed. 'delta' publishes only the points added since the
+        previous publish, plus a full snapshot every KEYFRAME_PERIOD seconds.
         """
-        if transform is None:
-            self.logger.error("Transform is None. Skipping point transformation.")
-            return None
+        now = self.get_clock().now()
+        if self.PUBLISH_MODE == 'delta' and (now - self.last_keyframe_time).nanoseconds >= self.KEYFRAME_PERIOD * 1e9:
+            self.keyframe_due = True
 
-        try:
-            # Check if transform contains NaN or Inf values
-            translation = transform.transform.translation
-            rotation = transform.transform.rotation
-            if any(math.isnan(val) or math.isinf(val) for val in [translation.x, translation.y, translation.z]):
-                self.logger.error(f"Transform contains invalid translation values: {translation}")
-                return None
-            if any(math.isnan(val) or math.isinf(val) for val in [rotation.x, rotation.y, rotation.z, rotation.w]):
-                self.logger.error(f"Transform contains invalid rotation values: {rotation}")
-                return None
-
-            point_stamped = PointStamped()
-            point_stamped.header.frame_id = transform.header.frame_id
-            point_stamped.point.x = float(point['x'])
-            point_stamped.point.y = float(point['y'])
-            point_stamped.point.z = float(point['z'])
-
-            transformed_point_stamped = do_transform_point(point_stamped, transform)
-            return {
-                'x': transformed_point_stamped.point.x,
-                'y': transformed_point_stamped.point.y,
-                'z': transformed_point_stamped.point.z,
-            }
-        except Exception as e:
-            self.logger.error(f"Failed to transform point: {e}")
-            return None
-
-    def publish_point_cloud(self):
+        if self.PUBLISH_MODE == 'snapshot' or self.keyframe_due:
+            if not self.keyframe_due and self.published_size == len(self.transformed_points):
+                return  # Nothing changed since the previous snapshot
+            self.publish_point_cloud(self.point_cloud_pub)
+            self.keyframe_due = False
+            self.last_keyframe_time = now
+
+        elif self.published_size < len(self.transformed_points):
+            self.publish_point_cloud(self.point_cloud_delta_pub, start=self.published_size)
+
+        self.published_size = len(self.transformed_points)
+
+    def publish_point_cloud(self, publisher, start=0):
         """
         Publish transformed points as a PointCloud2 message for visualization in RViz2.
-        Publishes x, y, z coordinates and label_id.
+        Publishes x, y, z coordinates and label_id of the stored points from row 'start' on.
         """
-        if not self.transformed_points:
-            return
-
         # Create a PointCloud2 message
         cloud_msg = PointCloud2()
         cloud_msg.header.stamp = self.get_clock().now().to_msg()
@@ -178,7 +215,7 @@ class SemanticPointcloudNode(Node):
 
         # Define the PointField structure for x, y, z, and label
         cloud_msg.height = 1
-        cloud_msg.width = len(self.transformed_points)
+        cloud_msg.width = len(self.transformed_points) - start
         cloud_msg.fields = [
             PointField(name='x', offset=0, datatype=PointField.FLOAT32, count=1),
             PointField(name='y', offset=4, datatype=PointField.FLOAT32, count=1),
@@ -190,45 +227,27 @@ class SemanticPointcloudNode(Node):
         cloud_msg.row_step = cloud_msg.point_step * cloud_msg.width
         cloud_msg.is_dense = True
 
-        # Serialize the point data with labels
-        cloud_data = []
-        for point in self.transformed_points:
-            cloud_data.append(struct.pack('fffI', point['x'], point['y'], point['z'], point['label']))
-        cloud_msg.data = b''.join(cloud_data)
+        # The store's rows already have the x, y, z, label layout, so the data is copied out in one go
+        cloud_msg.data = self.transformed_points.to_pointcloud2_data(start)
 
         # Publish the PointCloud2 message
-        self.point_cloud_pub.publish(cloud_msg)
+        publisher.publish(cloud_msg)
         #self.logger.fatal(f"Published PointCloud2 with {len(self.transformed_points)} points")
 
-    def reduce_points(self, points):
+    def reduce_points(self, xyz, labels):
         """
-        Reduces the number of points by keeping only those that are nage = 0.1ot
-        within a specified distance of another point.
+        Reduces the number of points by keeping a random SAMPLING_PERCENTAGE of them.
+        ImageSegmentationNode already voxel-decimates its clouds, so with a SAMPLING_PERCENTAGE of 1 this is skipped.
         """
+        if self.SAMPLING_PERCENTAGE >= 1.0:
+            return xyz, labels
      
-        num_points = len(points)
+        num_points = len(xyz)
         num_points_to_keep = int(num_points * self.SAMPLING_PERCENTAGE)
         
-        sampled_points = random.sample(points, num_points_to_keep)
-
-        return sampled_points
-
-    def is_point_too_close(self, point):
-        """
-        Check if the point is too close to any other point in the output point cloud.
-        """
-
-        for f_point in self.transformed_points:
-
-            dist = math.sqrt(
-                (point['x'] - f_point['x']) ** 2 +
-                (point['y'] - f_point['y']) ** 2 +
-                (point['z'] - f_point['z']) ** 2  # Ensure valid z values
-            )
-            if dist < self.DISTANCE_THRESHOLD:
-                return True  # The point is too close to an existing point
+        sampled_indices = self.rng.choice(num_points, num_points_to_keep, replace=False)
 
-        return False
+        return xyz[sampled_indices], labels[sampled_indices]
 
 def main():
     # Path for 'settings.json' file
@@ -242,6 +261,12 @@ def main():
     SAMPLING_PERCENTAGE = json_handler.get_subkey_value("SemanticPointcloudNode", "SAMPLING_PERCENTAGE")
     TIME_DIFF = json_handler.get_subkey_value("SemanticPointcloudNode", "TIME_DIFF")
     DISTANCE_THRESHOLD = json_handler.get_subkey_value("SemanticPointcloudNode", "DISTANCE_THRESHOLD")
+    PENDING_BUFFER_SIZE = json_handler.get_subkey_value("SemanticPointcloudNode", "PENDING_BUFFER_SIZE")
+    PENDING_MAX_AGE = json_handler.get_subkey_value("SemanticPointcloudNode", "PENDING_MAX_AGE")
+    PENDING_RETRY_PERIOD = json_handler.get_subkey_value("SemanticPointcloudNode", "PENDING_RETRY_PERIOD")
+    PUBLISH_MODE = json_handler.get_subkey_value("SemanticPointcloudNode", "PUBLISH_MODE")
+    PUBLISH_RATE = json_handler.get_subkey_value("SemanticPointcloudNode", "PUBLISH_RATE")
+    KEYFRAME_PERIOD = json_handler.get_subkey_value("SemanticPointcloudNode", "KEYFRAME_PERIOD")
 
     # Initialize the rclpy library.
     rclpy.init()
@@ -259,7 +284,9 @@ def main():
     rclpy.logging.set_logger_level("semantic_pointcloud_node", eval(NODE_LOG_LEVEL))
     
     # Instance the MapBuilerNode class
-    semantic_pointcloud_node = SemanticPointcloudNode(SAMPLING_PERCENTAGE, TIME_DIFF, DISTANCE_THRESHOLD)
+    semantic_pointcloud_node = SemanticPointcloudNode(SAMPLING_PERCENTAGE, TIME_DIFF, DISTANCE_THRESHOLD,
+                                                      PENDING_BUFFER_SIZE, PENDING_MAX_AGE, PENDING_RETRY_PERIOD,
+                                                      PUBLISH_MODE, PUBLISH_RATE, KEYFRAME_PERIOD)
     
     # Begin looping the node
     rclpy.spin(semantic_pointcloud_node)
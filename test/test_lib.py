@@ -0,0 +1,310 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from rob7_760_2024.LIB import (AdaptiveFrameScheduler, KeyframeSelector, LabeledPointStore, MaskPropagator,
+                               StampedMessageBuffer, VoxelHashIndex, align_instances_to_depth, depth_msg_to_metres,
+                               read_labeled_points, transform_points, transform_to_matrix)
+
+
+def sequential_insert(accepted_points, points, distance_threshold):
+    """
+    Reference for 'insert_if_far': the original per-point loop over every point accepted so far.
+    """
+    accepted = []
+    for point in points:
+        far = all(np.square(point - other).sum() >= np.float32(distance_threshold ** 2) for other in accepted_points)
+        accepted.append(far)
+        if far:
+            accepted_points.append(point)
+    return np.array(accepted, dtype=bool)
+
+
+@pytest.mark.parametrize('distance_threshold', [0.03, 0.1])
+def test_insert_if_far_matches_sequential_loop(distance_threshold):
+    rng = np.random.default_rng(0)
+    store = LabeledPointStore()
+    index = VoxelHashIndex(distance_threshold, store)
+    accepted_points = []
+
+    # Dense batches around the origin, so points conflict with the map and with each other across cell borders
+    for _ in range(5):
+        points = rng.uniform(-0.4, 0.4, size=(300, 3)).astype(np.float32)
+        labels = rng.integers(0, 10, size=300).astype(np.uint32)
+
+        expected = sequential_insert(accepted_points, points, distance_threshold)
+        np.testing.assert_array_equal(index.insert_if_far(points, labels), expected)
+
+    np.testing.assert_array_equal(store.xyz, np.array(accepted_points))
+    assert len(index) == len(store)
+
+
+def test_insert_if_far_stores_labels_and_clears_with_store():
+    store = LabeledPointStore()
+    index = VoxelHashIndex(0.05, store)
+
+    points = np.array([[0.0, 0.0, 0.0], [0.01, 0.0, 0.0], [1.0, 1.0, 1.0]], dtype=np.float32)
+    accepted = index.insert_if_far(points, np.array([3, 4, 5], dtype=np.uint32))
+
+    np.testing.assert_array_equal(accepted, [True, False, True])
+    np.testing.assert_array_equal(store.labels, [3, 5])
+    assert index.too_close(np.array([[0.02, 0.0, 0.0]])).tolist() == [True]
+
+    index.clear()
+    assert len(store) == 0
+    assert index.too_close(np.array([[0.02, 0.0, 0.0]])).tolist() == [False]
+
+
+def make_pointcloud2(xyz, labels, byte_order, point_step, row_padding, height=1):
+    """
+    PointCloud2-like message with x, y, z at offsets 0, 4, 8, the label at offset 16 and padded points and rows.
+    """
+    fields = [SimpleNamespace(name=name, offset=offset, datatype=datatype)
+              for name, offset, datatype in (('x', 0, 7), ('y', 4, 7), ('z', 8, 7), ('label', 16, 6))]
+    width = len(xyz) // height
+    row_step = width * point_step + row_padding
+
+    data = bytearray(row_step * height)
+    for index, ((x, y, z), label) in enumerate(zip(xyz, labels)):
+        start = (index // width) * row_step + (index % width) * point_step
+        data[start:start + 12] = np.array([x, y, z], dtype=byte_order + 'f4').tobytes()
+        data[start + 16:start + 20] = np.array([label], dtype=byte_order + 'u4').tobytes()
+
+    return SimpleNamespace(fields=fields, width=width, height=height, point_step=point_step, row_step=row_step,
+                           is_bigendian=(byte_order == '>'), data=bytes(data))
+
+
+@pytest.mark.parametrize('byte_order', ['<', '>'])
+def test_read_labeled_points_with_padded_rows(byte_order):
+    xyz = np.array([[1.0, 2.0, 3.0], [-1.5, 0.5, 2.5], [0.0, 0.0, 1.0], [4.0, 5.0, 6.0]], dtype=np.float32)
+    labels = np.array([1, 2, 70000, 3], dtype=np.uint32)
+    msg = make_pointcloud2(xyz, labels, byte_order, point_step=24, row_padding=8, height=2)
+
+    read_xyz, read_labels = read_labeled_points(msg)
+
+    np.testing.assert_array_equal(read_xyz, xyz)
+    np.testing.assert_array_equal(read_labels, labels)
+
+
+def test_read_labeled_points_skips_nans():
+    xyz = np.array([[1.0, 2.0, 3.0], [np.nan, 0.0, 1.0], [4.0, np.inf, 6.0]], dtype=np.float32)
+    msg = make_pointcloud2(xyz, [1, 2, 3], '<', point_step=20, row_padding=0)
+
+    read_xyz, read_labels = read_labeled_points(msg)
+    np.testing.assert_array_equal(read_xyz, xyz[:1])
+    np.testing.assert_array_equal(read_labels, [1])
+
+    assert len(read_labeled_points(msg, skip_nans=False)[0]) == 3
+
+
+def make_transform(translation, rotation):
+    """
+    TransformStamped-like message with a translation (x, y, z) and a rotation quaternion (x, y, z, w).
+    """
+    return SimpleNamespace(transform=SimpleNamespace(
+        translation=SimpleNamespace(x=translation[0], y=translation[1], z=translation[2]),
+        rotation=SimpleNamespace(x=rotation[0], y=rotation[1], z=rotation[2], w=rotation[3])))
+
+
+def axis_angle_matrix(axis, angle):
+    """
+    Reference rotation matrix from Rodrigues' formula, independent of the quaternion conversion.
+    """
+    axis = np.asarray(axis, dtype=np.float64) / np.linalg.norm(axis)
+    cross = np.array([[0.0, -axis[2], axis[1]], [axis[2], 0.0, -axis[0]], [-axis[1], axis[0], 0.0]])
+    return np.eye(3) + np.sin(angle) * cross + (1.0 - np.cos(angle)) * cross @ cross
+
+
+def test_transform_points_known_rotation_and_translation():
+    # 90 degrees about z, then a shift of (1, 2, 3)
+    half = np.sqrt(0.5)
+    rotation_matrix, translation = transform_to_matrix(make_transform((1.0, 2.0, 3.0), (0.0, 0.0, half, half)))
+
+    points = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0], [2.0, -1.0, 0.5]], dtype=np.float32)
+    transformed = transform_points(points, rotation_matrix, translation)
+
+    assert transformed.dtype == np.float32
+    np.testing.assert_allclose(transformed, [[1.0, 3.0, 3.0], [0.0, 2.0, 3.0], [1.0, 2.0, 4.0], [2.0, 4.0, 3.5]], atol=1e-6)
+
+
+def test_transform_to_matrix_matches_axis_angle():
+    axis = np.array([0.3, -0.5, 0.8])
+    angle = 2.1
+    quaternion = np.append(np.sin(angle / 2) * axis / np.linalg.norm(axis), np.cos(angle / 2))
+
+    # The quaternion does not need to be normalized
+    rotation_matrix, _ = transform_to_matrix(make_transform((0.0, 0.0, 0.0), 3.0 * quaternion))
+    np.testing.assert_allclose(rotation_matrix, axis_angle_matrix(axis, angle), atol=1e-12)
+
+
+@pytest.mark.parametrize('translation, rotation', [
+    ((np.nan, 0.0, 0.0), (0.0, 0.0, 0.0, 1.0)),
+    ((0.0, np.inf, 0.0), (0.0, 0.0, 0.0, 1.0)),
+    ((0.0, 0.0, 0.0), (0.0, np.nan, 0.0, 1.0)),
+    ((0.0, 0.0, 0.0), (0.0, 0.0, 0.0, 0.0)),
+])
+def test_transform_to_matrix_rejects_invalid_transforms(translation, rotation):
+    with pytest.raises(ValueError):
+        transform_to_matrix(make_transform(translation, rotation))
+
+
+def make_depth_msg(depth, encoding, row_padding=0):
+    depth = np.asarray(depth)
+    rows = [row.tobytes() + bytes(row_padding) for row in depth]
+    return SimpleNamespace(encoding=encoding, height=depth.shape[0], width=depth.shape[1], is_bigendian=False,
+                           step=depth.shape[1] * depth.itemsize + row_padding, data=b''.join(rows))
+
+
+def test_depth_msg_to_metres_16uc1():
+    depth = np.array([[0, 150, 1000], [2500, 4000, 65535]], dtype=np.uint16)
+    msg = make_depth_msg(depth, '16UC1', row_padding=2)
+
+    depth_image = depth_msg_to_metres(msg, 0.2, 3.0)
+
+    assert depth_image.dtype == np.float32
+    np.testing.assert_allclose(depth_image, [[0.0, 0.0, 1.0], [2.5, 0.0, 0.0]], rtol=1e-6)
+
+
+def test_depth_msg_to_metres_32fc1():
+    depth = np.array([[0.1, 0.2, 1.25], [3.0, 3.01, np.nan]], dtype=np.float32)
+    msg = make_depth_msg(depth, '32FC1')
+
+    depth_image = depth_msg_to_metres(msg, 0.2, 3.0)
+
+    # The range is inclusive, NaN compares false against both bounds and is left for back-projection to reject
+    np.testing.assert_allclose(depth_image[:, :2], [[0.0, 0.2], [3.0, 0.0]], rtol=1e-6)
+    assert depth_image[0, 2] == np.float32(1.25)
+    assert np.isnan(depth_image[1, 2])
+
+
+def test_depth_msg_to_metres_rejects_unknown_encoding():
+    with pytest.raises(ValueError):
+        depth_msg_to_metres(make_depth_msg(np.zeros((1, 1), dtype=np.uint8), '8UC1'), 0.2, 3.0)
+
+
+def make_stamp(nanoseconds):
+    return SimpleNamespace(sec=nanoseconds // 1000000000, nanosec=nanoseconds % 1000000000)
+
+
+def make_stamped_msg(nanoseconds):
+    return SimpleNamespace(header=SimpleNamespace(stamp=make_stamp(nanoseconds)))
+
+
+def test_stamped_message_buffer_matches_closest_within_tolerance():
+    buffer = StampedMessageBuffer(tolerance=0.05, buffer_size=10)
+    messages = [make_stamped_msg(stamp) for stamp in (1000000000, 1040000000, 1080000000, 1200000000)]
+    for msg in messages:
+        buffer.add(msg)
+
+    # Closest message wins, and the older ones are discarded with it
+    assert buffer.match(make_stamp(1070000000)) is messages[2]
+    assert list(buffer.buffer) == [messages[3]]
+
+    # Nothing within the tolerance leaves the buffer untouched
+    assert buffer.match(make_stamp(1100000000)) is None
+    assert list(buffer.buffer) == [messages[3]]
+
+    assert buffer.match(make_stamp(1250000000)) is messages[3]
+    assert buffer.newest_stamp_ns() is None
+
+
+def test_stamped_message_buffer_drops_oldest_when_full():
+    buffer = StampedMessageBuffer(tolerance=0.01, buffer_size=2)
+    for stamp in (1000000000, 2000000000, 3000000000):
+        buffer.add(make_stamped_msg(stamp))
+
+    assert buffer.match(make_stamp(1000000000)) is None
+    assert buffer.newest_stamp_ns() == 3000000000
+
+
+def test_align_instances_to_depth_letterbox_mapping():
+    # A 640x480 image letterboxed into a 640x384 model mask: gain 0.8, 64 pixels of padding left and right
+    image_shape = (480, 640)
+    mask_shape = (384, 640)
+
+    # Object covering image pixels x in [100, 300), y in [50, 250), i.e. mask pixels x in [144, 304), y in [40, 200)
+    full_mask = np.zeros(mask_shape, dtype=bool)
+    full_mask[40:200, 144:304] = True
+    mask_bbox = (136, 32, 312, 208)
+    instance = {
+        'label': 'cup',
+        'confidence': 0.9,
+        'bbox': (90, 40, 310, 260),
+        'mask': full_mask[mask_bbox[1]:mask_bbox[3], mask_bbox[0]:mask_bbox[2]],
+        'mask_bbox': mask_bbox,
+        'mask_shape': mask_shape,
+        'image_shape': image_shape,
+    }
+
+    # Depth at half the image resolution
+    aligned = align_instances_to_depth([instance], (240, 320))
+    assert len(aligned) == 1
+
+    x_min, y_min, x_max, y_max = aligned[0]['bbox']
+    assert (x_min, y_min, x_max, y_max) == (45, 20, 155, 130)
+
+    depth_mask = np.zeros((240, 320), dtype=bool)
+    depth_mask[y_min:y_max, x_min:x_max] = aligned[0]['mask']
+
+    # Depth pixels whose centre lies inside the object in image pixels
+    expected = np.zeros((240, 320), dtype=bool)
+    expected[25:125, 50:150] = True
+    np.testing.assert_array_equal(depth_mask, expected)
+
+
+def test_frame_scheduler_caps_frames_in_flight():
+    scheduler = AdaptiveFrameScheduler(target_rate=0.0, cpu_budget=0.0, smoothing=0.5, max_in_flight=2)
+
+    for _ in range(2):
+        assert scheduler.has_capacity()
+        scheduler.frame_started(now=0.0)
+
+    assert not scheduler.has_capacity()
+    assert not scheduler.should_process(now=1.0)
+    assert scheduler.skipped_frames == 1
+
+    scheduler.frame_finished(0.0, now=0.5)
+    assert scheduler.has_capacity()
+    assert scheduler.should_process(now=1.0)
+
+
+def make_pose(x):
+    return SimpleNamespace(position=SimpleNamespace(x=x, y=0.0, z=0.0),
+                           orientation=SimpleNamespace(x=0.0, y=0.0, z=0.0, w=1.0))
+
+
+def test_keyframe_selector_restores_reference_of_dropped_frame():
+    selector = KeyframeSelector(translation_threshold=0.1, rotation_threshold=0.1, refresh_period=10.0)
+    selector.update_pose(make_pose(0.0))
+    first = selector.mark_keyframe(now=0.0)
+
+    # The robot moves, a frame is marked and then dropped, so the next frame must still be a keyframe
+    selector.update_pose(make_pose(0.5))
+    previous = selector.mark_keyframe(now=1.0)
+    assert not selector.is_keyframe(now=1.5)
+    selector.restore_keyframe(previous, 1.0)
+    assert selector.is_keyframe(now=1.5)
+
+    # A dropped frame does not undo a frame marked after it
+    later = selector.mark_keyframe(now=2.0)
+    selector.mark_keyframe(now=3.0)
+    selector.restore_keyframe(later, 2.0)
+    assert selector.keyframe_time == 3.0
+    assert first == (None, None, None)
+
+
+def test_mask_propagator_detection_dropped():
+    propagator = MaskPropagator(detection_interval=5, change_threshold=0.1)
+    propagator.frames_since_detection = 4
+
+    token = propagator.detection_submitted()
+    assert propagator.frames_since_detection == 0
+    propagator.detection_dropped(token)
+    assert propagator.frames_since_detection == 4
+
+    # A later submitted detection is kept
+    token = propagator.detection_submitted()
+    propagator.detection_submitted()
+    propagator.detection_dropped(token)
+    assert propagator.frames_since_detection == 0
@@ -0,0 +1,25 @@
+import json
+import os
+import re
+
+import pytest
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read_settings():
+    with open(os.path.join(PACKAGE_ROOT, 'rob7_760_2024', 'settings.json')) as file:
+        return json.load(file)
+
+
+@pytest.mark.parametrize('launch_file', ['map_launch.py', 'rtabmap_tiago.launch.py'])
+def test_rtabmap_depth_range_matches_settings(launch_file):
+    # The launch files cannot read 'settings.json' at launch time, so their RTAB-Map constants are checked here
+    with open(os.path.join(PACKAGE_ROOT, 'launch', launch_file)) as file:
+        source = file.read()
+
+    settings = read_settings()['ImageSegmentationNode']
+    for parameter, key in (('RGBD/MinDepth', 'MIN_DEPTH'), ('RGBD/MaxDepth', 'MAX_DEPTH')):
+        match = re.search(rf"'{parameter}':\s*([0-9.]+)", source)
+        assert match is not None, f"'{parameter}' not found in {launch_file}"
+        assert float(match.group(1)) == float(settings[key]), f"'{parameter}' in {launch_file} differs from {key}"